@@ -0,0 +1,62 @@
+import asyncio
+import os
+import aiohttp
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Tamaño máximo de cada imagen descargada y conexiones simultáneas del pool HTTP
+MAX_ATTACHMENT_BYTES = int(os.getenv("MAX_ATTACHMENT_BYTES", str(8 * 1024 * 1024)))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+
+#these are the only image extentions it currently accepts
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+CHUNK_SIZE = 64 * 1024
+
+
+class AttachmentTooLarge(Exception):
+    """El adjunto supera MAX_ATTACHMENT_BYTES"""
+
+
+def create_http_session():
+    """Sesión HTTP compartida durante la vida del bot (reutiliza conexiones TCP/TLS)"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    )
+
+
+def image_attachments(message):
+    """Adjuntos del mensaje con extensión de imagen aceptada"""
+    return [attachment for attachment in message.attachments
+            if attachment.filename.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+async def download_attachment(session, url, max_bytes=MAX_ATTACHMENT_BYTES):
+    """Descargar un adjunto por bloques, abortando en cuanto supera max_bytes"""
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        if resp.content_length is not None and resp.content_length > max_bytes:
+            raise AttachmentTooLarge(f"{resp.content_length} bytes")
+        data = bytearray()
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                raise AttachmentTooLarge(f"más de {max_bytes} bytes")
+        return bytes(data)
+
+
+async def download_images(session, attachments, max_bytes=MAX_ATTACHMENT_BYTES):
+    """Descargar varios adjuntos a la vez; cada resultado son bytes o la excepción ocurrida"""
+    async def download(attachment):
+        # Discord informa el tamaño: evitar la petición si ya sabemos que es demasiado grande
+        if attachment.size > max_bytes:
+            raise AttachmentTooLarge(f"{attachment.size} bytes")
+        return await download_attachment(session, attachment.url, max_bytes)
+
+    results = await asyncio.gather(*(download(attachment) for attachment in attachments), return_exceptions=True)
+    for attachment, result in zip(attachments, results):
+        if isinstance(result, Exception):
+            print(f"Error descargando {attachment.filename}: {result}")
+    return results
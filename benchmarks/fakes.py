@@ -0,0 +1,635 @@
+"""Sustitutos locales de Discord, Gemini y MongoDB para los benchmarks.
+
+Implementan solo lo que usa el bot, con latencias configurables para simular
+la red sin necesitar token, API key ni base de datos.
+"""
+import asyncio
+import copy
+import threading
+import time
+from itertools import count
+from types import SimpleNamespace
+from bson import ObjectId
+from pymongo.operations import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+
+# ---------------------------------------------Discord-------------------------------------------------
+
+_ids = count(10**17)
+
+
+def snowflake():
+    return next(_ids)
+
+
+class FakeUser:
+    def __init__(self, user_id=None, name="usuario", bot=False):
+        self.id = user_id or snowflake()
+        self.name = name
+        self.bot = bot
+
+
+class FakeGuild:
+    def __init__(self, guild_id=None):
+        self.id = guild_id or snowflake()
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.id = snowflake()
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        await self.channel._api_call()
+        self.content = content
+        self.channel.edits += 1
+        return self
+
+
+class FakeChannel:
+    """Canal que guarda lo enviado; `send_latency` simula el viaje a la API de Discord"""
+
+    def __init__(self, channel_id=None, send_latency=0.0):
+        self.id = channel_id or snowflake()
+        self.send_latency = send_latency
+        self.sent = []
+        self.edits = 0
+        self._replied = asyncio.Event()
+
+    async def _api_call(self):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+
+    def typing(self):
+        return _Typing()
+
+    async def send(self, content=None, **kwargs):
+        await self._api_call()
+        sent = FakeSentMessage(self, content)
+        self.sent.append(sent)
+        self._replied.set()
+        return sent
+
+    async def wait_reply(self):
+        """Esperar al siguiente mensaje enviado al canal"""
+        await self._replied.wait()
+        self._replied.clear()
+
+
+class FakeMessage:
+    def __init__(self, author, channel, content, guild=None, mentions=(), mention_everyone=False, attachments=()):
+        self.id = snowflake()
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.content = content
+        self.mentions = list(mentions)
+        self.mention_everyone = mention_everyone
+        self.attachments = list(attachments)
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+# ---------------------------------------------Gemini-------------------------------------------------
+
+
+class StubModel:
+    """Modelo con la interfaz async de google.generativeai y latencia fija"""
+
+    def __init__(self, latency=0.5, response_text="Respuesta de prueba. " * 20, model_name="models/stub", chunks=8):
+        self.latency = latency
+        self.response_text = response_text
+        self.model_name = model_name
+        self.chunks = chunks
+        self.calls = 0
+
+    async def generate_content_async(self, prompt_parts, stream=False, request_options=None):
+        self.calls += 1
+        if stream:
+            return self._stream()
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(text=self.response_text, parts=[self.response_text])
+
+    async def _stream(self):
+        size = -(-len(self.response_text) // self.chunks)
+        for start in range(0, len(self.response_text), size):
+            await asyncio.sleep(self.latency / self.chunks)
+            text = self.response_text[start:start + size]
+            yield SimpleNamespace(text=text, parts=[text])
+
+# ---------------------------------------------MongoDB-------------------------------------------------
+
+
+def _get(document, path):
+    value = document
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _candidates(document, path):
+    """Valores de `path`, recorriendo arrays como hace MongoDB ("turns.timestamp")"""
+    values = [document]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+            elif isinstance(value, dict) and part in value:
+                found.append(value[part])
+        values = found
+    return values or [None]
+
+
+def _compare(value, operator, expected):
+    if operator == "$eq":
+        return value == expected
+    if operator == "$ne":
+        return value != expected
+    if operator == "$in":
+        return value in expected
+    if operator == "$nin":
+        return value not in expected
+    if operator == "$exists":
+        return (value is not None) == bool(expected)
+    if operator == "$size":
+        return isinstance(value, list) and len(value) == expected
+    if value is None or expected is None:
+        return False
+    if operator == "$gt":
+        return value > expected
+    if operator == "$gte":
+        return value >= expected
+    if operator == "$lt":
+        return value < expected
+    if operator == "$lte":
+        return value <= expected
+    raise NotImplementedError(f"Operador de consulta no soportado: {operator}")
+
+
+def matches(document, query):
+    """Evaluar un filtro de MongoDB (igualdad, comparaciones, $and/$or) sobre un documento"""
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(document, sub) for sub in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(document, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            if "$size" in condition:
+                if not all(_compare(_get(document, key), op, expected) for op, expected in condition.items()):
+                    return False
+            elif not any(all(_compare(value, op, expected) for op, expected in condition.items())
+                         for value in _candidates(document, key)):
+                return False
+        elif condition not in _candidates(document, key):
+            return False
+    return True
+
+
+def _sort_key(value):
+    # None primero, como en MongoDB
+    return (value is not None, value)
+
+
+def _apply_update(document, update, inserting):
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            *parents, field = path.split(".")
+            target = document
+            for part in parents:
+                target = target.setdefault(part, {})
+            if operator == "$set" or (operator == "$setOnInsert" and inserting):
+                target[field] = copy.deepcopy(value)
+            elif operator == "$unset":
+                target.pop(field, None)
+            elif operator == "$inc":
+                target[field] = target.get(field, 0) + value
+            elif operator == "$max":
+                if target.get(field) is None or value > target[field]:
+                    target[field] = value
+            elif operator == "$min":
+                if target.get(field) is None or value < target[field]:
+                    target[field] = value
+            elif operator == "$push":
+                items = target.setdefault(field, [])
+                if isinstance(value, dict) and "$each" in value:
+                    items.extend(copy.deepcopy(value["$each"]))
+                    if "$slice" in value:
+                        limit = value["$slice"]
+                        items[:] = items[limit:] if limit < 0 else items[:limit]
+                else:
+                    items.append(copy.deepcopy(value))
+            elif operator == "$pull":
+                if isinstance(target.get(field), list):
+                    target[field] = [item for item in target[field]
+                                     if not (matches(item, value) if isinstance(value, dict) else item == value)]
+            elif operator != "$setOnInsert":
+                raise NotImplementedError(f"Operador de actualización no soportado: {operator}")
+
+
+def _project(document, projection):
+    if not projection:
+        return copy.deepcopy(document)
+    include_id = projection.get("_id", 1)
+    slices = {key: value["$slice"] for key, value in projection.items() if isinstance(value, dict) and "$slice" in value}
+    # Las rutas con punto ("turns.timestamp") incluyen el campo de primer nivel completo
+    fields = {key.split(".")[0]: value for key, value in projection.items() if key != "_id" and key not in slices}
+    if not fields or all(not value for value in fields.values()):
+        result = {key: value for key, value in document.items() if key not in fields}
+    else:
+        result = {key: document[key] for key in list(fields) + list(slices) if key in document}
+        if "_id" in document:
+            result["_id"] = document["_id"]
+    for key, limit in slices.items():
+        if isinstance(result.get(key), list):
+            result[key] = result[key][limit:] if limit < 0 else result[key][:limit]
+    if not include_id:
+        result.pop("_id", None)
+    return copy.deepcopy(result)
+
+
+def _set(document, path, value):
+    *parents, field = path.split(".")
+    for part in parents:
+        document = document.setdefault(part, {})
+    document[field] = value
+
+
+def _expression(document, expression):
+    """Evaluar una expresión de agregación: "$campo", literales y los operadores que usa database.py"""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return _get(document, expression[1:])
+    if isinstance(expression, list):
+        return [_expression(document, item) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith("$"):
+        return {key: _expression(document, value) for key, value in expression.items()}
+    operator, arguments = next(iter(expression.items()))
+    if operator == "$literal":
+        return arguments
+    if operator == "$cond":
+        if isinstance(arguments, dict):
+            arguments = [arguments["if"], arguments["then"], arguments["else"]]
+        condition, then, otherwise = arguments
+        return _expression(document, then if _expression(document, condition) else otherwise)
+    values = _expression(document, arguments if isinstance(arguments, list) else [arguments])
+    if operator in ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte"):
+        return _compare(values[0], operator, values[1])
+    if operator == "$concat":
+        return None if None in values else "".join(values)
+    if operator == "$substrCP":
+        text, start, length = values
+        return (text or "")[start:start + length]
+    if operator == "$size":
+        return len(values[0])
+    if operator == "$ifNull":
+        return next((value for value in values if value is not None), None)
+    raise NotImplementedError(f"Operador de expresión no soportado: {operator}")
+
+
+def _accumulate(groups, key, document, accumulators):
+    if key not in groups:
+        groups[key] = {"_id": copy.deepcopy(key), **{name: [] for name in accumulators}}
+    for name, accumulator in accumulators.items():
+        groups[key][name].append(_expression(document, next(iter(accumulator.values()))))
+
+
+def _finish_group(group, accumulators):
+    for name, accumulator in accumulators.items():
+        operator = next(iter(accumulator))
+        values = group[name]
+        present = [value for value in values if value is not None]
+        if operator == "$sum":
+            group[name] = sum(value for value in present if isinstance(value, (int, float)))
+        elif operator == "$avg":
+            group[name] = sum(present) / len(present) if present else None
+        elif operator == "$min":
+            group[name] = min(present, default=None)
+        elif operator == "$max":
+            group[name] = max(present, default=None)
+        elif operator == "$first":
+            group[name] = values[0]
+        elif operator == "$last":
+            group[name] = values[-1]
+        elif operator == "$push":
+            group[name] = values
+        elif operator == "$addToSet":
+            group[name] = [value for index, value in enumerate(values) if value not in values[:index]]
+        else:
+            raise NotImplementedError(f"Acumulador no soportado: {operator}")
+    return group
+
+
+def _group(documents, spec):
+    accumulators = {name: value for name, value in spec.items() if name != "_id"}
+    groups = {}
+    for document in documents:
+        key = _expression(document, spec["_id"])
+        # Los dict no son hashables: agrupar por sus pares ordenados
+        _accumulate(groups, tuple(sorted(key.items())) if isinstance(key, dict) else key, document, accumulators)
+    results = []
+    for key, group in groups.items():
+        if isinstance(key, tuple):
+            group["_id"] = dict(key)
+        results.append(_finish_group(group, accumulators))
+    return results
+
+
+def _unwind(documents, spec):
+    path = (spec["path"] if isinstance(spec, dict) else spec)[1:]
+    for document in documents:
+        for item in _get(document, path) or []:
+            unwound = copy.deepcopy(document)
+            _set(unwound, path, copy.deepcopy(item))
+            yield unwound
+
+
+def _aggregate_project(document, spec):
+    include_id = spec.get("_id", 1)
+    fields = {key: value for key, value in spec.items() if key != "_id"}
+    if fields and all(value in (0, False) for value in fields.values()):
+        result = _project(document, spec)
+    else:
+        result = {}
+        for key, value in fields.items():
+            if value in (1, True):
+                if _get(document, key) is not None:
+                    _set(result, key, copy.deepcopy(_get(document, key)))
+            else:
+                _set(result, key, _expression(document, value))
+        if include_id and "_id" in document:
+            result["_id"] = document["_id"]
+    if not include_id:
+        result.pop("_id", None)
+    return result
+
+
+def aggregate(documents, pipeline):
+    """Ejecutar las etapas de agregación que usa database.py sobre copias de `documents`"""
+    if pipeline and "$match" in pipeline[0]:
+        # Copiar solo lo que pasa el primer filtro, como si usara un índice
+        documents = [document for document in documents if matches(document, pipeline[0]["$match"])]
+        pipeline = pipeline[1:]
+    documents = [copy.deepcopy(document) for document in documents]
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif name == "$sort":
+            for key, direction in reversed(list(spec.items())):
+                documents.sort(key=lambda document: _sort_key(_get(document, key)), reverse=direction < 0)
+        elif name == "$skip":
+            documents = documents[spec:]
+        elif name == "$limit":
+            documents = documents[:spec]
+        elif name == "$project":
+            documents = [_aggregate_project(document, spec) for document in documents]
+        elif name in ("$set", "$addFields"):
+            for document in documents:
+                for key, value in [(key, _expression(document, value)) for key, value in spec.items()]:
+                    _set(document, key, value)
+        elif name == "$unwind":
+            documents = list(_unwind(documents, spec))
+        elif name == "$group":
+            documents = _group(documents, spec)
+        elif name == "$count":
+            documents = [{spec: len(documents)}] if documents else []
+        else:
+            raise NotImplementedError(f"Etapa de agregación no soportada: {name}")
+    return documents
+
+
+class MemoryCursor:
+    def __init__(self, collection, query, projection):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key, direction=1):
+        self._sort = list(key) if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        if self._results is None:
+            self._results = self._collection._find(self._query, self._projection, self._sort, self._skip, self._limit)
+        return iter(self._results)
+
+
+class MemoryCollection:
+    """Colección en memoria con los métodos de pymongo que usa database.py"""
+
+    def __init__(self, client, name):
+        self._client = client
+        self.name = name
+        self._documents = {}
+        self.indexes = {}
+
+    def _operation(self):
+        # Simular el viaje de red en el hilo que llama, como el driver real
+        if self._client.latency:
+            time.sleep(self._client.latency)
+        return self._client._lock
+
+    def create_index(self, keys, name=None, **options):
+        with self._operation():
+            name = name or "_".join(f"{key}_{direction}" for key, direction in keys)
+            self.indexes[name] = {"key": keys, **options}
+            return name
+
+    def index_information(self):
+        with self._operation():
+            return {name: dict(index) for name, index in self.indexes.items()}
+
+    def drop_index(self, name):
+        with self._operation():
+            del self.indexes[name]
+
+    def _insert(self, document):
+        document.setdefault("_id", ObjectId())
+        self._documents[document["_id"]] = copy.deepcopy(document)
+        return document["_id"]
+
+    def insert_one(self, document):
+        with self._operation():
+            return SimpleNamespace(inserted_id=self._insert(document), acknowledged=True)
+
+    def insert_many(self, documents, ordered=True):
+        with self._operation():
+            return SimpleNamespace(inserted_ids=[self._insert(document) for document in documents], acknowledged=True)
+
+    def _find(self, query, projection, sort, skip, limit):
+        with self._operation():
+            documents = [document for document in self._documents.values() if matches(document, query)]
+            for key, direction in reversed(sort):
+                documents.sort(key=lambda document: _sort_key(_get(document, key)), reverse=direction < 0)
+            documents = documents[skip:skip + limit if limit else None]
+            return [_project(document, projection) for document in documents]
+
+    def find(self, filter=None, projection=None):
+        return MemoryCursor(self, filter, projection)
+
+    def find_one(self, filter=None, projection=None):
+        for document in self.find(filter, projection).limit(1):
+            return document
+        return None
+
+    def _update(self, query, update, upsert, many):
+        matched = [document for document in self._documents.values() if matches(document, query)]
+        if not many:
+            matched = matched[:1]
+        for document in matched:
+            _apply_update(document, update, inserting=False)
+        upserted_id = None
+        if not matched and upsert:
+            document = {key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+            _apply_update(document, update, inserting=True)
+            upserted_id = self._insert(document)
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched), upserted_id=upserted_id, acknowledged=True)
+
+    def update_one(self, filter, update, upsert=False):
+        with self._operation():
+            return self._update(filter, update, upsert, many=False)
+
+    def update_many(self, filter, update, upsert=False):
+        with self._operation():
+            return self._update(filter, update, upsert, many=True)
+
+    def _delete(self, query, many):
+        deleted = [key for key, document in self._documents.items() if matches(document, query)]
+        if not many:
+            deleted = deleted[:1]
+        for key in deleted:
+            del self._documents[key]
+        return SimpleNamespace(deleted_count=len(deleted), acknowledged=True)
+
+    def delete_one(self, filter):
+        with self._operation():
+            return self._delete(filter, many=False)
+
+    def delete_many(self, filter):
+        with self._operation():
+            return self._delete(filter, many=True)
+
+    def bulk_write(self, requests, ordered=True):
+        """Un solo viaje para todas las operaciones, como el bulk_write real"""
+        with self._operation():
+            result = SimpleNamespace(inserted_count=0, matched_count=0, modified_count=0, deleted_count=0,
+                                     upserted_count=0, upserted_ids={}, acknowledged=True)
+            for index, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                    result.inserted_count += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    updated = self._update(request._filter, request._doc, request._upsert, many=isinstance(request, UpdateMany))
+                    result.matched_count += updated.matched_count
+                    result.modified_count += updated.modified_count
+                    if updated.upserted_id is not None:
+                        result.upserted_ids[index] = updated.upserted_id
+                        result.upserted_count += 1
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    result.deleted_count += self._delete(request._filter, many=isinstance(request, DeleteMany)).deleted_count
+                else:
+                    raise NotImplementedError(f"Operación no soportada: {type(request).__name__}")
+            return result
+
+    def find_one_and_delete(self, filter, projection=None):
+        with self._operation():
+            for key, document in self._documents.items():
+                if matches(document, filter):
+                    del self._documents[key]
+                    return _project(document, projection)
+            return None
+
+    def count_documents(self, filter):
+        with self._operation():
+            return sum(1 for document in self._documents.values() if matches(document, filter))
+
+    def estimated_document_count(self):
+        with self._operation():
+            return len(self._documents)
+
+    def aggregate(self, pipeline, **kwargs):
+        with self._operation():
+            return iter(aggregate(self._documents.values(), pipeline))
+
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        with self.client._lock:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self.client, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def command(self, command, *args, **kwargs):
+        name = command if isinstance(command, str) else next(iter(command))
+        if name == "ping":
+            return {"ok": 1}
+        if name == "collMod":
+            # Solo el cambio de expireAfterSeconds de un índice TTL
+            index = kwargs["index"]
+            self[args[0]].indexes[index["name"]]["expireAfterSeconds"] = index["expireAfterSeconds"]
+            return {"ok": 1}
+        raise NotImplementedError(f"Comando no soportado: {name}")
+
+
+class MemoryMongoClient:
+    """Cliente MongoDB en memoria; `latency` son los segundos que tarda cada operación"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.RLock()
+        self._databases = {}
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = MemoryDatabase(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    @property
+    def admin(self):
+        return self["admin"]
+
+    def close(self):
+        pass
@@ -0,0 +1,249 @@
+"""Benchmarks offline del bot (sin Discord, Gemini ni MongoDB reales).
+
+Uso, desde la raíz del repositorio:
+
+    python -m benchmarks.run --concurrency 1,8,32 --output resultados.json
+    python -m benchmarks.run --compare resultados.json
+
+Mide mensajes/segundo, latencias p50/p99 y memoria de `on_message` de punta a
+punta, de `split_and_send_messages` y de los métodos de la base de datos.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import time
+
+# main.py exige estas variables al importarse; MONGODB_URI vacía evita conectar a una base real
+os.environ.setdefault("GOOGLE_AI_KEY", "benchmark")
+os.environ.setdefault("DISCORD_BOT_TOKEN", "benchmark")
+os.environ.setdefault("MAX_HISTORY", "10")
+os.environ["MONGODB_URI"] = ""
+os.environ["WEB_SERVER"] = "false"
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeChannel, FakeGuild, FakeMessage, FakeUser, MemoryMongoClient, StubModel  # noqa: E402
+from cache import HistoryCache, ResponseCache  # noqa: E402
+from database import AsyncBotDatabase, BotDatabase, HISTORY_LAYOUT  # noqa: E402
+from send_scheduler import SendScheduler  # noqa: E402
+
+BOT_ID = 4242
+GUILDS = 10
+# Unos 7000 caracteres: varios mensajes, por debajo del envío como archivo
+LONG_REPLY = ("Un párrafo de respuesta con varias frases para partir en mensajes. " * 12 + "\n\n") * 9
+
+
+def percentile(values, fraction):
+    """Percentil por rango más cercano (values ya ordenados)"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def summarize(name, concurrency, latencies, elapsed, memory_before):
+    latencies = sorted(latencies)
+    return {
+        "name": name,
+        "concurrency": concurrency,
+        "operations": len(latencies),
+        "ops_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "rss_mb": round(main.memory_usage_mb(), 1),
+        "rss_delta_mb": round(main.memory_usage_mb() - memory_before, 1),
+    }
+
+
+def memory_database(args):
+    """BotDatabase sobre MongoDB en memoria"""
+    return BotDatabase(client=MemoryMongoClient(latency=args.db_latency), layout=args.layout)
+
+
+async def run_clients(concurrency, operations, operation):
+    """Ejecutar `operations` llamadas repartidas entre `concurrency` clientes; devuelve (latencias, segundos)"""
+    latencies = []
+
+    async def client(client_id):
+        for index in range(client_id, operations, concurrency):
+            start = time.perf_counter()
+            await operation(client_id, index)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(client_id) for client_id in range(concurrency)))
+    return latencies, time.perf_counter() - start
+
+
+def install_fakes(args, use_db):
+    """Sustituir en main los modelos, cachés y base de datos por los locales"""
+    main.text_model = StubModel(latency=args.model_latency, model_name="models/stub-text")
+    main.image_model = StubModel(latency=args.model_latency, model_name="models/stub-image")
+    main.message_filter.bot_id = BOT_ID
+    main.turn_queue.coalesce_window = args.coalesce_window
+    main.turn_queue.first_wait = args.first_wait
+    main.history_cache = HistoryCache(max_turns=main.MAX_HISTORY)
+    main.response_cache = ResponseCache()
+    install_scheduler(args)
+    main.db = AsyncBotDatabase(memory_database(args), history_cache=main.history_cache) if use_db else None
+    return main.db
+
+
+def install_scheduler(args):
+    # Sin --channel-send-rate los envíos no se espacian y se mide solo el coste propio
+    main.send_scheduler = SendScheduler(rate=args.channel_send_rate or 10**9, window=args.channel_send_window)
+
+
+async def bench_on_message(args, concurrency, use_db):
+    """Conversaciones simultáneas de punta a punta: cada usuario espera la respuesta antes de escribir otra vez"""
+    db = install_fakes(args, use_db)
+    if db:
+        await db.start()
+    memory_before = main.memory_usage_mb()
+    guilds = [FakeGuild() for _ in range(GUILDS)]
+    bot_user = FakeUser(BOT_ID, name="Lyla", bot=True)
+    users = [FakeUser(name=f"usuario{index}") for index in range(concurrency)]
+    channels = [FakeChannel(send_latency=args.send_latency) for _ in range(concurrency)]
+
+    async def converse(client_id, index):
+        channel = channels[client_id]
+        message = FakeMessage(
+            users[client_id], channel, f"<@{BOT_ID}> Pregunta número {index} sobre el tema {client_id}",
+            guild=guilds[client_id % GUILDS], mentions=[bot_user]
+        )
+        await main.on_message(message)
+        await channel.wait_reply()
+
+    latencies, elapsed = await run_clients(concurrency, args.messages * concurrency, converse)
+    # Guardados en DB y otros pasos posteriores a la respuesta
+    await main.turn_queue.drain()
+    result = summarize("on_message" + ("" if use_db else " (sin DB)"), concurrency, latencies, elapsed, memory_before)
+    if db:
+        await db.close()
+    return result
+
+
+async def bench_split_and_send(args, concurrency):
+    """Partir y enviar una respuesta larga (varios mensajes de Discord)"""
+    install_scheduler(args)
+    memory_before = main.memory_usage_mb()
+    channels = [FakeChannel(send_latency=args.send_latency) for _ in range(concurrency)]
+    messages = [FakeMessage(FakeUser(), channel, "") for channel in channels]
+
+    async def send(client_id, index):
+        await main.split_and_send_messages(messages[client_id], LONG_REPLY)
+
+    latencies, elapsed = await run_clients(concurrency, args.operations, send)
+    return summarize("split_and_send_messages", concurrency, latencies, elapsed, memory_before)
+
+
+async def bench_database(args, concurrency):
+    """Métodos de AsyncBotDatabase contra MongoDB en memoria con latencia simulada"""
+    results = []
+    users = 100
+    db = AsyncBotDatabase(memory_database(args), history_cache=HistoryCache(max_turns=main.MAX_HISTORY))
+    await db.start()
+    # Historial previo: MAX_HISTORY turnos por usuario
+    for user_id in range(users):
+        for turn in range(main.MAX_HISTORY):
+            db.sync.save_message(user_id, f"mensaje {turn}", f"respuesta {turn}", guild_id=user_id % GUILDS)
+
+    operations = {
+        "save_message": lambda client_id, index: db.save_message(index % users, "mensaje", "respuesta", index % GUILDS),
+        "get_user_history": lambda client_id, index: db.get_user_history(index % users, main.MAX_HISTORY),
+        "get_history_turns": lambda client_id, index: db.get_history_turns(index % users, main.MAX_HISTORY),
+        "get_conversations_page": lambda client_id, index: db.get_conversations_page(index % users, 20, truncate=200),
+        "get_user_stats": lambda client_id, index: db.get_user_stats(index % users),
+        "get_server_stats": lambda client_id, index: db.get_server_stats(index % GUILDS),
+        "get_global_stats": lambda client_id, index: db.get_global_stats(),
+    }
+    for name, operation in operations.items():
+        memory_before = main.memory_usage_mb()
+        latencies, elapsed = await run_clients(concurrency, args.operations, operation)
+        results.append(summarize(f"db.{name}", concurrency, latencies, elapsed, memory_before))
+    await db.close()
+    return results
+
+
+def print_results(results, previous=None):
+    previous = {(result["name"], result["concurrency"]): result for result in previous or []}
+    header = f"{'benchmark':<28}{'conc':>6}{'ops':>8}{'ops/s':>12}{'p50 ms':>11}{'p99 ms':>11}{'RSS MB':>9}"
+    if previous:
+        header += f"{'Δ ops/s':>10}{'Δ p99':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        line = (f"{result['name']:<28}{result['concurrency']:>6}{result['operations']:>8}{result['ops_per_s']:>12.1f}"
+                f"{result['p50_ms']:>11.2f}{result['p99_ms']:>11.2f}{result['rss_mb']:>9.1f}")
+        before = previous.get((result["name"], result["concurrency"]))
+        if before:
+            line += f"{change(before['ops_per_s'], result['ops_per_s']):>10}{change(before['p99_ms'], result['p99_ms']):>9}"
+        print(line)
+
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+async def run(args):
+    results = []
+    # Los print del bot por mensaje ensucian la tabla; --verbose los conserva
+    with open(os.devnull, "w") as devnull:
+        with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull):
+            await run_benchmarks(args, results)
+    return results
+
+
+async def run_benchmarks(args, results):
+    for concurrency in args.concurrency:
+        if "on_message" in args.only:
+            results.append(await bench_on_message(args, concurrency, use_db=True))
+            results.append(await bench_on_message(args, concurrency, use_db=False))
+        if "split" in args.only:
+            results.append(await bench_split_and_send(args, concurrency))
+        if "db" in args.only:
+            results.extend(await bench_database(args, concurrency))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmarks offline de Lyla")
+    parser.add_argument("--concurrency", default="1,8,32", help="Niveles de concurrencia separados por comas")
+    parser.add_argument("--messages", type=int, default=5, help="Mensajes por usuario en on_message")
+    parser.add_argument("--operations", type=int, default=500, help="Operaciones por nivel en split y db")
+    parser.add_argument("--model-latency", type=float, default=0.2, help="Segundos que tarda el modelo simulado")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="Segundos por operación de MongoDB en memoria")
+    parser.add_argument("--layout", choices=("documents", "ring"), default=HISTORY_LAYOUT, help="Formato del historial (HISTORY_LAYOUT)")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="Segundos por envío a Discord")
+    parser.add_argument("--channel-send-rate", type=int, default=0, help="Envíos por canal y ventana (0: sin límite)")
+    parser.add_argument("--channel-send-window", type=float, default=5.0, help="Segundos de la ventana de envíos por canal")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="TURN_COALESCE_WINDOW durante la prueba")
+    parser.add_argument("--first-wait", type=float, default=0.0, help="TURN_FIRST_WAIT durante la prueba")
+    parser.add_argument("--only", default="on_message,split,db", help="Benchmarks a ejecutar: on_message, split, db")
+    parser.add_argument("--verbose", action="store_true", help="Mostrar los mensajes que imprime el bot")
+    parser.add_argument("--output", help="Guardar los resultados en JSON")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior con el que comparar")
+    args = parser.parse_args()
+    args.concurrency = [int(value) for value in args.concurrency.split(",")]
+    args.only = set(args.only.split(","))
+
+    results = asyncio.run(run(args))
+    previous = None
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)["results"]
+    print_results(results, previous)
+
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "only", "verbose")}
+        config.update(python=platform.python_version(), max_history=main.MAX_HISTORY, stream=main.STREAM_RESPONSES)
+        with open(args.output, "w") as file:
+            json.dump({"created": time.time(), "config": config, "results": results}, file, indent=2)
+        print(f"Resultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main_cli()
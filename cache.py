@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Límites del caché de historial: usuarios, caracteres totales y segundos de inactividad
+HISTORY_CACHE_MAX_USERS = int(os.getenv("HISTORY_CACHE_MAX_USERS", "1000"))
+HISTORY_CACHE_MAX_CHARS = int(os.getenv("HISTORY_CACHE_MAX_CHARS", "5000000"))
+HISTORY_CACHE_TTL = float(os.getenv("HISTORY_CACHE_TTL", "1800"))
+# Caché de respuestas sin historial: entradas máximas (0 = desactivado) y segundos de validez
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "0"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Caché LRU acotado por número de entradas, tamaño total y TTL.
+
+    `sizeof` calcula el tamaño de cada valor; cuando se supera `max_size`
+    se expulsan las entradas menos usadas recientemente.
+    """
+
+    def __init__(self, max_entries, ttl=None, max_size=None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # clave -> (valor, expira_en, tamaño)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        value = self.peek(key, _MISSING)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """Leer una entrada vigente sin contarla ni cambiar su orden LRU"""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        value, expires_at, _ = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.pop(key)
+            return default
+        return value
+
+    def set(self, key, value):
+        self.pop(key)
+        size = self.sizeof(value)
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at, size)
+        self.size += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.size -= entry[2]
+        return entry[0]
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def _evict(self):
+        now = time.monotonic()
+        # Primero las entradas caducadas, luego las menos usadas
+        for key in [key for key, (_, expires_at, _) in self._data.items()
+                    if expires_at is not None and expires_at <= now]:
+            self.pop(key)
+        while self._data and (len(self._data) > self.max_entries
+                              or (self.max_size is not None and self.size > self.max_size)):
+            self.pop(next(iter(self._data)))
+
+
+def _turns_size(turns):
+    return sum(len(turn["message"]) + len(turn["response"]) for turn in turns)
+
+
+class HistoryCache:
+    """Caché por usuario de los últimos turnos de conversación.
+
+    Cada turno es un dict con `message`, `response` y `timestamp`, del más
+    antiguo al más reciente. Sustituye al diccionario global sin expulsión.
+    Es local al proceso: en un cluster AsyncBotDatabase(shared_history=True)
+    comprueba contra MongoDB que sigue al día antes de usarlo.
+    """
+
+    def __init__(self, max_turns, max_users=HISTORY_CACHE_MAX_USERS,
+                 max_chars=HISTORY_CACHE_MAX_CHARS, ttl=HISTORY_CACHE_TTL):
+        self.max_turns = max_turns
+        self._cache = LRUCache(max_users, ttl=ttl, max_size=max_chars, sizeof=_turns_size)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    def get(self, user_id):
+        """Turnos en caché del usuario, o None si no están cargados"""
+        return self._cache.get(str(user_id))
+
+    def set(self, user_id, turns):
+        """Cargar el historial completo (recortado a max_turns) de un usuario"""
+        self._cache.set(str(user_id), list(turns)[-self.max_turns:] if self.max_turns else [])
+
+    def append(self, user_id, turn, create=False):
+        """Añadir un turno; si el usuario no está en caché solo se crea con create=True"""
+        turns = self._cache.peek(str(user_id))
+        if turns is None:
+            if not create:
+                return
+            turns = []
+        self.set(user_id, turns + [turn])
+
+    def invalidate(self, user_id):
+        self._cache.pop(str(user_id))
+
+
+def normalize_prompt(text):
+    """Normalizar un prompt para que variantes triviales compartan entrada en caché"""
+    return " ".join(text.casefold().split()).strip("¿?¡!.,;: ")
+
+
+def image_digest(data):
+    """Huella de contenido de una imagen"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResponseCache:
+    """Caché de respuestas direccionado por contenido.
+
+    La clave es un hash de la configuración del modelo, el prompt normalizado,
+    las huellas de las imágenes y si la petición iba sin historial, de modo que
+    un cambio en gasmii.py invalida las respuestas anteriores.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self._cache = LRUCache(max_entries, ttl=ttl)
+
+    @property
+    def enabled(self):
+        return self._cache.max_entries > 0
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    def key(self, model_config, prompt="", images=(), history_free=True):
+        digest = hashlib.sha256()
+        digest.update(json.dumps(model_config, sort_keys=True, default=str).encode())
+        digest.update(b"\0" + normalize_prompt(prompt or "").encode())
+        for image in images:
+            digest.update(b"\0" + image.encode())
+        digest.update(b"\0" + (b"1" if history_free else b"0"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        return self._cache.get(key) if self.enabled else None
+
+    def set(self, key, response):
+        if self.enabled:
+            self._cache.set(key, response)
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+load_dotenv()
+
+CHATBOT_CHANNELS_FILE = 'chatbot_channels.json'
+# Segundos entre comprobaciones de cambios hechos por otros procesos (workers del cluster)
+CHANNEL_REGISTRY_RELOAD = float(os.getenv("CHANNEL_REGISTRY_RELOAD", "5"))
+
+
+class ChannelRegistry:
+    """Canales de chatbot configurados por servidor.
+
+    Mantiene en memoria un set con los IDs de todos los canales para que
+    on_message los consulte en O(1), admite varios canales por servidor y
+    persiste en JSON escribiendo a un archivo temporal que luego reemplaza
+    al original, de forma atómica.
+
+    Varios procesos (los workers de cluster.py) comparten el archivo: cada
+    cambio se hace bajo un bloqueo de archivo, releyendo antes el estado en
+    disco, y `watch()` recarga el registro cuando otro proceso lo modifica.
+
+    Formato: {"<guild_id>": {"channel_ids": ["<channel_id>", ...]}}. También
+    se lee el formato anterior {"<guild_id>": {"channel_id": "<channel_id>"}}.
+    """
+
+    def __init__(self, path=CHATBOT_CHANNELS_FILE):
+        self.path = path
+        self._guilds = {}
+        self.channel_ids = set()
+        self._save_lock = threading.Lock()
+        self._signature = None
+        self.load()
+
+    def _stat(self):
+        # Cambia con cada reemplazo del archivo, aunque lo haga otro proceso
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read(self):
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+        guilds = {}
+        for guild_id, config in data.items():
+            channel_ids = config.get('channel_ids') or ([config['channel_id']] if 'channel_id' in config else [])
+            if channel_ids:
+                guilds[guild_id] = {str(channel_id) for channel_id in channel_ids}
+        return guilds
+
+    def _apply(self, guilds):
+        # Asignaciones completas: on_message nunca ve un set a medio modificar
+        self._guilds = guilds
+        self.channel_ids = {int(channel_id) for channels in guilds.values() for channel_id in channels}
+
+    def load(self):
+        """Cargar el registro desde disco (si el archivo existe)"""
+        signature = self._stat()
+        self._apply(self._read())
+        self._signature = signature
+
+    def reload_if_changed(self):
+        """Recargar si otro proceso modificó el archivo; devuelve True si se recargó"""
+        if self._stat() == self._signature:
+            return False
+        with self._save_lock:
+            self.load()
+        return True
+
+    async def watch(self, interval=CHANNEL_REGISTRY_RELOAD):
+        """Comprobar periódicamente los cambios de otros procesos"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except Exception as e:
+                print(f"Error recargando {self.path}: {e}")
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, guilds):
+        """Escribir el registro de forma atómica (archivo temporal + reemplazo)"""
+        data = {guild_id: {'channel_ids': sorted(channels)} for guild_id, channels in guilds.items()}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.chatbot_channels.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(data, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _toggle(self, guild_id, channel_id):
+        with self._save_lock, self._file_lock():
+            # Partir del estado en disco para no pisar los cambios de otros workers
+            guilds = self._read()
+            channels = guilds.setdefault(guild_id, set())
+            enabled = channel_id not in channels
+            if enabled:
+                channels.add(channel_id)
+            else:
+                channels.discard(channel_id)
+            if not channels:
+                del guilds[guild_id]
+            self._write(guilds)
+            self._apply(guilds)
+            self._signature = self._stat()
+        return enabled
+
+    async def toggle(self, guild_id, channel_id):
+        """Activar o desactivar un canal; devuelve True si queda activado"""
+        return await asyncio.to_thread(self._toggle, str(guild_id), str(channel_id))
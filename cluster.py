@@ -0,0 +1,138 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.request
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Procesos worker entre los que se reparten los shards
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "2"))
+# Discord permite un IDENTIFY cada 5 segundos (max_concurrency = 1)
+IDENTIFY_INTERVAL = 5
+RESTART_DELAY = 5
+# Segundos que tiene cada worker para volcar sus datos y cerrar tras SIGTERM
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", "20"))
+
+
+def recommended_shard_count(token):
+    """Número de shards recomendado por Discord para este bot"""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (Lyla, 1.0.0)"}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+def shard_ranges(shard_count, workers):
+    """Repartir los shards en rangos contiguos, uno por worker"""
+    workers = max(1, min(workers, shard_count))
+    base, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for index in range(workers):
+        size = base + (1 if index < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def run_worker(worker_id, shard_ids, shard_count, statuses):
+    """Punto de entrada de cada proceso worker"""
+    # main lee la configuración de shards del entorno al importarse
+    os.environ["SHARD_IDS"] = ",".join(str(shard_id) for shard_id in shard_ids)
+    os.environ["SHARD_COUNT"] = str(shard_count)
+    import main
+
+    main.bot.status_board = statuses
+    main.bot.worker_id = worker_id
+    main.bot.run(main.DISCORD_BOT_TOKEN)
+
+
+def start_worker(context, worker_id, shard_ids, shard_count, statuses):
+    process = context.Process(
+        target=run_worker,
+        args=(worker_id, shard_ids, shard_count, statuses),
+        name=f"lyla-worker-{worker_id}"
+    )
+    process.start()
+    print(f"🚀 Worker {worker_id} iniciado con shards {shard_ids[0]}-{shard_ids[-1]} de {shard_count} (pid {process.pid})")
+    return process
+
+
+def supervise(context, ranges, shard_count, statuses, workers, stopping, lock):
+    """Arrancar los workers escalonadamente y reiniciar los que terminen, hasta que se active `stopping`"""
+    for worker_id, shard_ids in enumerate(ranges):
+        with lock:
+            if stopping.is_set():
+                return
+            workers[worker_id] = start_worker(context, worker_id, shard_ids, shard_count, statuses)
+        # Dejar que el worker identifique sus shards antes de lanzar el siguiente
+        if stopping.wait(IDENTIFY_INTERVAL * len(shard_ids)):
+            return
+
+    while not stopping.wait(RESTART_DELAY):
+        with lock:
+            if stopping.is_set():
+                return
+            for worker_id, process in list(workers.items()):
+                if not process.is_alive():
+                    print(f"⚠️ Worker {worker_id} terminó (código {process.exitcode}), reiniciando...")
+                    statuses.pop(worker_id, None)
+                    workers[worker_id] = start_worker(context, worker_id, ranges[worker_id], shard_count, statuses)
+
+
+def stop_workers(workers, stopping, lock, timeout=WORKER_STOP_TIMEOUT):
+    """Reenviar SIGTERM a los workers y esperar a que cierren; matar los que no lo hagan a tiempo"""
+    with lock:
+        stopping.set()
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + timeout
+    for worker_id, process in workers.items():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            print(f"⚠️ Worker {worker_id} no cerró en {timeout:g}s, forzando la salida")
+            process.kill()
+            process.join()
+
+
+def _exit_on_sigterm(signum, frame):
+    # Salir por la vía normal para que main() pare los workers
+    sys.exit(0)
+
+
+def main():
+    token = os.getenv("DISCORD_BOT_TOKEN")
+    if not token:
+        raise ValueError("Falta la variable de entorno DISCORD_BOT_TOKEN")
+    shard_count = int(os.getenv("SHARD_COUNT") or recommended_shard_count(token))
+    ranges = shard_ranges(shard_count, CLUSTER_WORKERS)
+
+    context = multiprocessing.get_context("spawn")
+    manager = context.Manager()
+    statuses = manager.dict()
+    workers, stopping, lock = {}, threading.Event(), threading.Lock()
+    threading.Thread(
+        target=supervise, args=(context, ranges, shard_count, statuses, workers, stopping, lock), daemon=True
+    ).start()
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+    # El proceso principal solo sirve la web, agregando el estado de todos los workers
+    from web_server import serve_cluster
+
+    try:
+        asyncio.run(serve_cluster(statuses))
+    finally:
+        stop_workers(workers, stopping, lock)
+
+
+if __name__ == "__main__":
+    main()
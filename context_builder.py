@@ -0,0 +1,49 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Presupuesto aproximado de tokens para historial + mensaje actual
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "3000"))
+# Guardar un resumen acumulado de los turnos que no caben en el presupuesto
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "false").lower() == "true"
+
+# Gemini cuenta ~4 caracteres por token en texto corriente
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """Estimación barata de tokens sin llamar a count_tokens"""
+    return len(text) // CHARS_PER_TOKEN + 1 if text else 0
+
+
+def turn_tokens(turn):
+    """Tokens de un turno; se calculan una vez y quedan guardados en el propio turno"""
+    tokens = turn.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(turn["message"]) + estimate_tokens(turn["response"])
+        turn["tokens"] = tokens
+    return tokens
+
+
+class ContextBuilder:
+    """Elige los turnos del historial que caben en un presupuesto de tokens.
+
+    Conserva los turnos más recientes que caben y descarta primero los más
+    antiguos; el resumen acumulado (si lo hay) y el mensaje actual también
+    cuentan para el presupuesto.
+    """
+
+    def __init__(self, token_budget=HISTORY_TOKEN_BUDGET):
+        self.token_budget = token_budget
+
+    def select(self, turns, text, summary=None):
+        """Devolver (turnos que caben, turnos descartados), ambos del más antiguo al más reciente"""
+        available = self.token_budget - estimate_tokens(text) - estimate_tokens(summary)
+        kept = 0
+        for turn in reversed(turns):
+            available -= turn_tokens(turn)
+            if available < 0:
+                break
+            kept += 1
+        return turns[len(turns) - kept:], turns[:len(turns) - kept]
@@ -1,46 +1,312 @@
 
+import argparse
+import asyncio
+import functools
+import gzip
+import json
 import os
+import threading
+import time
+import zlib
 import pymongo
-from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+from pymongo.results import DeleteResult
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from bson import Binary, ObjectId, json_util
 from dotenv import load_dotenv
+from cache import LRUCache, HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_TTL
+from metrics import MONGO_LATENCY
 
 load_dotenv()
 
+# Ajustes del pool de conexiones y timeouts de MongoDB
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", "20"))
+MONGODB_TIMEOUT_MS = int(os.getenv("MONGODB_TIMEOUT_MS", "5000"))
+# Hilos dedicados a ejecutar las operaciones de la variante asíncrona
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+# Escritura diferida de contadores de actividad: cada cuántos segundos o eventos se vuelcan
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+STATS_FLUSH_EVENTS = int(os.getenv("STATS_FLUSH_EVENTS", "500"))
+# Segundos durante los que se reutiliza una lectura de estadísticas (/stats y /dashboard)
+STATS_SNAPSHOT_TTL = float(os.getenv("STATS_SNAPSHOT_TTL", "30"))
+# Retención de conversaciones (0 = conservar siempre). Con HISTORY_ARCHIVE_DIR los turnos
+# caducados se archivan en JSONL comprimido antes de borrarse; sin archivo puede usarse un índice TTL
+HISTORY_RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR") or None
+HISTORY_TTL_INDEX = os.getenv("HISTORY_TTL_INDEX", "false").lower() == "true"
+HISTORY_PRUNE_INTERVAL = float(os.getenv("HISTORY_PRUNE_INTERVAL", "3600"))
+HISTORY_PRUNE_BATCH = int(os.getenv("HISTORY_PRUNE_BATCH", "1000"))
+# Formato del historial: "documents" (un documento por turno en `conversations`) o "ring"
+# (un documento por usuario en `histories` con los últimos HISTORY_RING_SIZE turnos)
+HISTORY_LAYOUT = os.getenv("HISTORY_LAYOUT", "documents")
+HISTORY_RING_SIZE = int(os.getenv("HISTORY_RING_SIZE", "50"))
+# Comprimir con zlib los turnos largos del formato "ring"
+HISTORY_COMPRESSION = os.getenv("HISTORY_COMPRESSION", "false").lower() == "true"
+HISTORY_COMPRESS_MIN_BYTES = 256
+# Tamaño máximo de página de /api/conversations
+CONVERSATIONS_PAGE_MAX = 500
+
+EPOCH = datetime(1970, 1, 1)
+# Código de error de MongoDB al borrar un índice que no existe
+INDEX_NOT_FOUND = 27
+# El índice TTL borra sin archivar: solo se usa si no hay directorio de archivo (y no aplica a "ring")
+USE_TTL_INDEX = HISTORY_RETENTION_DAYS > 0 and HISTORY_TTL_INDEX and not HISTORY_ARCHIVE_DIR and HISTORY_LAYOUT == "documents"
+
+def history_turn(conversation):
+    """Convertir un documento de `conversations` en un turno de historial"""
+    return {
+        "message": conversation["message"],
+        "response": conversation["response"],
+        "timestamp": conversation["timestamp"]
+    }
+
+
+def format_history(turns):
+    """Formatear turnos (del más antiguo al más reciente) para el modelo de IA"""
+    formatted = []
+    for turn in turns:
+        formatted.append(turn["message"])
+        formatted.append(turn["response"])
+    return '\n\n'.join(formatted)
+
+
+def pack_turn(message, response, guild_id=None, timestamp=None, compress=HISTORY_COMPRESSION):
+    """Turno tal como se guarda en el array de `histories`"""
+    turn = {"timestamp": timestamp or datetime.now(), "guild_id": str(guild_id) if guild_id else None}
+    if compress:
+        payload = json.dumps([message, response], ensure_ascii=False).encode("utf-8")
+        if len(payload) >= HISTORY_COMPRESS_MIN_BYTES:
+            packed = zlib.compress(payload)
+            # Solo si realmente ocupa menos
+            if len(packed) < len(payload):
+                turn["z"] = Binary(packed)
+                return turn
+    turn["message"] = message
+    turn["response"] = response
+    return turn
+
+
+def unpack_turn(user_id, turn):
+    """Turno de `histories` con la misma forma que un documento de `conversations`"""
+    conversation = {"user_id": user_id, "guild_id": turn.get("guild_id"), "timestamp": turn["timestamp"]}
+    if "z" in turn:
+        conversation["message"], conversation["response"] = json.loads(zlib.decompress(turn["z"]))
+    else:
+        conversation["message"], conversation["response"] = turn["message"], turn["response"]
+    return conversation
+
+
+def encode_cursor(timestamp, conversation_id=None):
+    """Cursor opaco de paginación: milisegundos de la fecha y _id del último documento de la página.
+
+    En el formato "ring" los turnos no tienen _id: en su lugar va cuántos turnos
+    con esa misma fecha se han servido ya.
+    """
+    milliseconds = (timestamp - EPOCH) // timedelta(milliseconds=1)
+    return f"{milliseconds}-{conversation_id or ''}"
+
+
+def decode_cursor(cursor):
+    """Inverso de encode_cursor; lanza ValueError si el cursor no es válido"""
+    milliseconds, _, conversation_id = cursor.partition("-")
+    try:
+        timestamp = EPOCH + timedelta(milliseconds=int(milliseconds))
+    except OverflowError:
+        raise ValueError(f"cursor no válido: {cursor}") from None
+    if not conversation_id:
+        return timestamp, None
+    # Un ObjectId tiene 24 caracteres hexadecimales; un número corto es una posición del formato ring
+    if conversation_id.isdigit() and len(conversation_id) < 24:
+        return timestamp, int(conversation_id)
+    if not ObjectId.is_valid(conversation_id):
+        raise ValueError(f"cursor no válido: {cursor}")
+    return timestamp, ObjectId(conversation_id)
+
+
+def truncate_text(text, max_chars):
+    if max_chars is None or len(text) <= max_chars:
+        return text
+    return text[:max_chars] + "..."
+
+
+def _plan_stages(plan):
+    """Aplanar las etapas de un plan de explain() desde la raíz hacia las hojas"""
+    stages = [plan["stage"]]
+    children = plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else [])
+    for child in children:
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+def _plan_indexes(plan):
+    """Nombres de los índices usados por un plan de explain()"""
+    indexes = [plan["indexName"]] if "indexName" in plan else []
+    children = plan.get("inputStages") or ([plan["inputStage"]] if "inputStage" in plan else [])
+    for child in children:
+        indexes.extend(_plan_indexes(child))
+    return indexes
+
+
 class BotDatabase:
-    def __init__(self):
+    def __init__(self, client=None, layout=HISTORY_LAYOUT):
+        if layout not in ("documents", "ring"):
+            raise ValueError(f"HISTORY_LAYOUT debe ser 'documents' o 'ring', no '{layout}'")
+        self.layout = layout
+        # Se puede inyectar un cliente ya creado (por ejemplo, el MongoDB en memoria de benchmarks/)
+        if client is None:
+            client = self._connect()
+        self.client = client
+        self.db = self.client.lyla_bot
+        
+        # Colecciones
+        self.conversations = self.db.conversations
+        # Historial reciente por usuario (HISTORY_LAYOUT=ring)
+        self.histories = self.db.histories
+        self.users = self.db.users
+        self.servers = self.db.servers
+        self.stats = self.db.stats
+        # Pares (servidor, usuario) vistos: respaldan el contador de usuarios activos
+        self.server_members = self.db.server_members
+        
+        # Lecturas recientes de estadísticas compartidas entre el bot y el servidor web
+        self._snapshots = LRUCache(1024, ttl=STATS_SNAPSHOT_TTL)
+        self._snapshots_lock = threading.Lock()
+        
+        self.ensure_indexes()
+        
+    def _connect(self):
         self.mongodb_uri = os.getenv("MONGODB_URI")
         if not self.mongodb_uri:
             raise ValueError("MONGODB_URI no está configurada en las variables de entorno")
         
         try:
-            self.client = pymongo.MongoClient(self.mongodb_uri)
+            client = pymongo.MongoClient(
+                self.mongodb_uri,
+                maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS,
+                connectTimeoutMS=MONGODB_TIMEOUT_MS,
+                socketTimeoutMS=MONGODB_TIMEOUT_MS
+            )
             # Probar la conexión
-            self.client.admin.command('ping')
-            self.db = self.client.lyla_bot
+            client.admin.command('ping')
             print("✅ Conexión a MongoDB exitosa")
         except Exception as e:
             print(f"❌ Error conectando a MongoDB: {e}")
             raise
+        return client
+    
+    def ensure_indexes(self):
+        """Crear los índices de las consultas frecuentes (idempotente)"""
+        indexes = [
+            # Incluye _id para que la paginación por cursor (timestamp, _id) no necesite ordenar en memoria
+            (self.conversations, [("user_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {"name": "user_id_timestamp_id"}),
+            (self.conversations, [("guild_id", ASCENDING), ("user_id", ASCENDING)], {"name": "guild_id_user_id"}),
+            (self.users, [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+            (self.servers, [("guild_id", ASCENDING)], {"name": "guild_id_unique", "unique": True}),
+            (self.server_members, [("guild_id", ASCENDING), ("user_id", ASCENDING)], {"name": "guild_id_user_id_unique", "unique": True}),
+            (self.histories, [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+        ]
+        for collection, keys, options in indexes:
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                # Por ejemplo, duplicados previos que impiden un índice único
+                print(f"⚠️ No se pudo crear el índice {collection.name}.{options['name']}: {e}")
+        # Sustituido por user_id_timestamp_id, que sirve a las mismas consultas
+        if "user_id_timestamp" in self.conversations.index_information():
+            self._drop_index(self.conversations, "user_id_timestamp")
+        self.ensure_retention_index()
+
+    @staticmethod
+    def _drop_index(collection, name):
+        """Borrar un índice; en un cluster otro proceso puede haberlo borrado ya"""
+        try:
+            collection.drop_index(name)
+        except OperationFailure as e:
+            if e.code != INDEX_NOT_FOUND:
+                print(f"⚠️ No se pudo borrar el índice {collection.name}.{name}: {e}")
+    
+    def ensure_retention_index(self):
+        """Índice por fecha para la retención: TTL (MongoDB borra solo) o normal (para el pruner)"""
+        wanted = None
+        if USE_TTL_INDEX:
+            wanted = "timestamp_ttl"
+        elif HISTORY_RETENTION_DAYS > 0:
+            wanted = "timestamp"
+        try:
+            # Un índice TTL que ya no se quiere seguiría borrando historial
+            for name in set(self.conversations.index_information()) & {"timestamp", "timestamp_ttl"} - {wanted}:
+                self._drop_index(self.conversations, name)
+            if wanted == "timestamp_ttl":
+                expire_after = int(HISTORY_RETENTION_DAYS * 86400)
+                try:
+                    self.conversations.create_index([("timestamp", ASCENDING)], name=wanted, expireAfterSeconds=expire_after)
+                except OperationFailure:
+                    # Ya existe con otra retención: actualizarla en el sitio
+                    self.db.command("collMod", "conversations", index={"name": wanted, "expireAfterSeconds": expire_after})
+            elif wanted:
+                self.conversations.create_index([("timestamp", ASCENDING)], name=wanted)
+        except OperationFailure as e:
+            print(f"⚠️ No se pudo preparar el índice de retención: {e}")
+    
+    def explain_hot_queries(self, user_id, guild_id, history_limit=10):
+        """Obtener el plan de ejecución de cada consulta frecuente"""
+        user_id, guild_id = str(user_id), str(guild_id)
+        if self.layout == "ring":
+            history_query = {"find": "histories", "filter": {"user_id": user_id},
+                             "projection": {"turns": {"$slice": -history_limit}}, "limit": 1}
+        else:
+            history_query = {"find": "conversations", "filter": {"user_id": user_id},
+                             "sort": {"timestamp": -1}, "limit": history_limit}
+        queries = {
+            "get_user_history": history_query,
+            "get_user_stats": {"find": "users", "filter": {"user_id": user_id}, "limit": 1},
+            "get_server_stats": {"find": "servers", "filter": {"guild_id": guild_id}, "limit": 1},
+            "server_members": {"find": "server_members", "filter": {"guild_id": guild_id, "user_id": user_id}, "limit": 1},
+        }
+        plans = {}
+        for name, command in queries.items():
+            result = self.db.command({"explain": command, "verbosity": "executionStats"})
+            winning_plan = result["queryPlanner"]["winningPlan"]
+            winning_plan = winning_plan.get("queryPlan", winning_plan)
+            execution = result.get("executionStats", {})
+            plans[name] = {
+                "stages": _plan_stages(winning_plan),
+                "indexes": _plan_indexes(winning_plan),
+                "keys_examined": execution.get("totalKeysExamined"),
+                "docs_examined": execution.get("totalDocsExamined"),
+                "returned": execution.get("nReturned"),
+            }
+        return plans
         
-        # Colecciones
-        self.conversations = self.db.conversations
-        self.users = self.db.users
-        self.servers = self.db.servers
-        self.stats = self.db.stats
-        
-    def save_message(self, user_id, message, response, guild_id=None):
+    def save_message(self, user_id, message, response, guild_id=None, timestamp=None):
         """Guardar conversación en la base de datos"""
+        if self.layout == "ring":
+            # Una sola actualización: añadir el turno y descartar los que sobran
+            return self.histories.update_one(
+                {"user_id": str(user_id)},
+                {"$push": {"turns": {"$each": [pack_turn(message, response, guild_id, timestamp)], "$slice": -HISTORY_RING_SIZE}}},
+                upsert=True
+            )
         conversation = {
             "user_id": str(user_id),
             "guild_id": str(guild_id) if guild_id else None,
             "message": message,
             "response": response,
-            "timestamp": datetime.now()
+            "timestamp": timestamp or datetime.now()
         }
         return self.conversations.insert_one(conversation)
     
     def get_user_history(self, user_id, limit=None):
         """Obtener historial de conversaciones de un usuario"""
+        if self.layout == "ring":
+            # Lectura puntual por user_id; $slice devuelve solo los últimos turnos
+            projection = {"turns": {"$slice": -limit}} if limit else {"turns": 1}
+            history = self.histories.find_one({"user_id": str(user_id)}, projection) or {}
+            return [unpack_turn(str(user_id), turn) for turn in reversed(history.get("turns", []))]
+        
         query = {"user_id": str(user_id)}
         cursor = self.conversations.find(query).sort("timestamp", -1)
         
@@ -49,20 +315,225 @@ class BotDatabase:
             
         return list(cursor)
     
+    def get_conversations_page(self, user_id, limit=50, cursor=None, since=None, truncate=None):
+        """Una página de conversaciones de un usuario, de la más reciente a la más antigua.
+
+        Pagina por cursor (timestamp, _id) en lugar de saltar documentos, filtra
+        opcionalmente por `since` y recorta `response` a `truncate` caracteres
+        en el servidor. Devuelve (conversaciones, cursor de la página siguiente o None).
+        """
+        after = decode_cursor(cursor) if cursor else None
+        if self.layout == "ring":
+            return self._ring_page(str(user_id), limit, after, since, truncate)
+        
+        match = {"user_id": str(user_id)}
+        if since:
+            match["timestamp"] = {"$gte": since}
+        if after:
+            timestamp, conversation_id = after
+            match["$or"] = [{"timestamp": {"$lt": timestamp}}]
+            if isinstance(conversation_id, ObjectId):
+                match["$or"].append({"timestamp": timestamp, "_id": {"$lt": conversation_id}})
+        response = "$response"
+        if truncate is not None:
+            # Hay más de `truncate` caracteres si queda alguno a partir de esa posición
+            response = {"$cond": [
+                {"$eq": [{"$substrCP": ["$response", truncate, 1]}, ""]},
+                "$response",
+                {"$concat": [{"$substrCP": ["$response", 0, truncate]}, "..."]}
+            ]}
+        conversations = list(self.conversations.aggregate([
+            {"$match": match},
+            {"$sort": {"timestamp": -1, "_id": -1}},
+            # Un documento de más para saber si hay otra página
+            {"$limit": limit + 1},
+            {"$project": {"message": 1, "timestamp": 1, "response": response}}
+        ]))
+        next_cursor = None
+        if len(conversations) > limit:
+            conversations = conversations[:limit]
+            next_cursor = encode_cursor(conversations[-1]["timestamp"], conversations[-1]["_id"])
+        return conversations, next_cursor
+    
+    def _ring_page(self, user_id, limit, after, since, truncate):
+        # El array tiene como mucho HISTORY_RING_SIZE turnos: se pagina en memoria
+        turns = self.get_user_history(user_id)
+        if since:
+            turns = [turn for turn in turns if turn["timestamp"] >= since]
+        served = 0
+        if after:
+            # Saltar los turnos con la fecha del cursor que ya salieron en páginas anteriores
+            timestamp, served = after[0], after[1] if isinstance(after[1], int) else 0
+            ties = 0
+            remaining = []
+            for turn in turns:
+                if turn["timestamp"] == timestamp:
+                    ties += 1
+                    if ties > served:
+                        remaining.append(turn)
+                elif turn["timestamp"] < timestamp:
+                    remaining.append(turn)
+            turns = remaining
+        page = [dict(turn, response=truncate_text(turn["response"], truncate)) for turn in turns[:limit]]
+        next_cursor = None
+        if len(turns) > limit:
+            last = page[-1]["timestamp"]
+            ties = sum(1 for turn in page if turn["timestamp"] == last)
+            if after and last == after[0]:
+                ties += served
+            next_cursor = encode_cursor(last, ties)
+        return page, next_cursor
+    
+    def get_latest_turn_time(self, user_id):
+        """Fecha del último turno guardado del usuario, o None si no tiene historial"""
+        if self.layout == "ring":
+            history = self.histories.find_one({"user_id": str(user_id)}, {"turns": {"$slice": -1}}) or {}
+            turns = history.get("turns") or [{}]
+            return turns[-1].get("timestamp")
+        # Cubierta por el índice user_id_timestamp_id
+        cursor = self.conversations.find({"user_id": str(user_id)}, {"timestamp": 1, "_id": 0}).sort("timestamp", -1).limit(1)
+        latest = next(iter(cursor), None)
+        return latest["timestamp"] if latest else None
+
     def get_formatted_history(self, user_id, max_messages):
         """Obtener historial formateado para el modelo de IA"""
         history = self.get_user_history(user_id, max_messages)
-        formatted = []
-        
-        for conv in reversed(history):  # Más reciente al final
-            formatted.append(conv["message"])
-            formatted.append(conv["response"])
-        
-        return '\n\n'.join(formatted)
+        # Más reciente al final
+        return format_history(history_turn(conv) for conv in reversed(history))
     
     def clear_user_history(self, user_id):
         """Limpiar historial de un usuario"""
-        return self.conversations.delete_many({"user_id": str(user_id)})
+        self.users.update_one(
+            {"user_id": str(user_id)},
+            {"$unset": {"history_summary": "", "summary_until": ""}}
+        )
+        result = self.conversations.delete_many({"user_id": str(user_id)})
+        if self.layout != "ring":
+            return result
+        history = self.histories.find_one_and_delete({"user_id": str(user_id)}, {"turns.timestamp": 1}) or {}
+        return DeleteResult({"n": result.deleted_count + len(history.get("turns", []))}, True)
+    
+    def get_history_summary(self, user_id):
+        """Obtener el resumen acumulado de los turnos antiguos de un usuario"""
+        user_data = self.users.find_one(
+            {"user_id": str(user_id)},
+            {"history_summary": 1, "summary_until": 1}
+        ) or {}
+        return {
+            "summary": user_data.get("history_summary"),
+            "until": user_data.get("summary_until")
+        }
+    
+    def save_history_summary(self, user_id, summary, until):
+        """Guardar el resumen acumulado y la marca de tiempo del último turno resumido"""
+        self.users.update_one(
+            {"user_id": str(user_id)},
+            {"$set": {"history_summary": summary, "summary_until": until}},
+            upsert=True
+        )
+    
+    def prune_conversations(self, cutoff, archive_dir=None, batch_size=HISTORY_PRUNE_BATCH):
+        """Borrar las conversaciones anteriores a `cutoff`, de lote en lote.
+
+        Con `archive_dir`, cada lote se escribe en un JSONL comprimido y se
+        sincroniza en disco antes de borrarlo. Los contadores de estadísticas
+        no cambian (rebuild-stats solo contaría el historial que queda).
+        Devuelve el número de conversaciones eliminadas.
+        """
+        archive = None
+
+        def archive_batch(conversations):
+            nonlocal archive
+            if archive is None:
+                archive = ConversationArchive(archive_dir)
+            archive.write(conversations)
+
+        try:
+            removed = self._prune_documents(cutoff, archive_batch if archive_dir else None, batch_size)
+            if self.layout == "ring":
+                removed += self._prune_histories(cutoff, archive_batch if archive_dir else None, batch_size)
+        finally:
+            if archive is not None:
+                archive.close()
+        return removed
+    
+    def _prune_documents(self, cutoff, archive_batch, batch_size):
+        query = {"timestamp": {"$lt": cutoff}}
+        projection = None if archive_batch else {"_id": 1}
+        removed = 0
+        while True:
+            batch = list(self.conversations.find(query, projection).sort("timestamp", ASCENDING).limit(batch_size))
+            if not batch:
+                return removed
+            if archive_batch:
+                archive_batch(batch)
+            self.conversations.delete_many({"_id": {"$in": [conv["_id"] for conv in batch]}})
+            removed += len(batch)
+    
+    def _prune_histories(self, cutoff, archive_batch, batch_size):
+        # Recorrer los usuarios con turnos caducados por _id y quitar esos turnos del array
+        query = {"turns.timestamp": {"$lt": cutoff}}
+        last_id = None
+        removed = 0
+        while True:
+            page = query if last_id is None else dict(query, _id={"$gt": last_id})
+            batch = list(self.histories.find(page, {"user_id": 1, "turns": 1}).sort("_id", ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            expired = [unpack_turn(history["user_id"], turn) for history in batch
+                       for turn in history["turns"] if turn["timestamp"] < cutoff]
+            if archive_batch:
+                archive_batch(expired)
+            self.histories.bulk_write([
+                UpdateOne({"_id": history["_id"]}, {"$pull": {"turns": {"timestamp": {"$lt": cutoff}}}})
+                for history in batch
+            ], ordered=False)
+            removed += len(expired)
+        self.histories.delete_many({"turns": {"$size": 0}})
+        return removed
+    
+    def count_expired_conversations(self, cutoff):
+        """Conversaciones anteriores a `cutoff` (lo que borraría prune_conversations)"""
+        count = self.conversations.count_documents({"timestamp": {"$lt": cutoff}})
+        if self.layout == "ring":
+            for result in self.histories.aggregate([
+                {"$match": {"turns.timestamp": {"$lt": cutoff}}},
+                {"$unwind": "$turns"},
+                {"$match": {"turns.timestamp": {"$lt": cutoff}}},
+                {"$count": "expired"}
+            ]):
+                count += result["expired"]
+        return count
+    
+    def migrate_to_ring(self, batch_size=500):
+        """Copiar a `histories` los últimos HISTORY_RING_SIZE turnos de cada usuario de `conversations`.
+
+        Se puede repetir sin duplicar turnos: fusiona por fecha con lo que ya
+        haya en `histories`. Conviene ejecutarla con el bot detenido o justo
+        después de cambiar a HISTORY_LAYOUT=ring. Devuelve los usuarios migrados.
+        """
+        migrated = 0
+        requests = []
+        for group in self.conversations.aggregate([{"$group": {"_id": "$user_id"}}], allowDiskUse=True):
+            user_id = group["_id"]
+            recent = self.conversations.find({"user_id": user_id}).sort("timestamp", DESCENDING).limit(HISTORY_RING_SIZE)
+            existing = (self.histories.find_one({"user_id": user_id}, {"turns": 1}) or {}).get("turns", [])
+            turns = {turn["timestamp"]: turn for turn in existing}
+            for conv in recent:
+                turns.setdefault(conv["timestamp"], pack_turn(conv["message"], conv["response"], conv.get("guild_id"), conv["timestamp"]))
+            requests.append(UpdateOne(
+                {"user_id": user_id},
+                {"$set": {"turns": [turns[timestamp] for timestamp in sorted(turns)][-HISTORY_RING_SIZE:]}},
+                upsert=True
+            ))
+            migrated += 1
+            if len(requests) >= batch_size:
+                self.histories.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            self.histories.bulk_write(requests, ordered=False)
+        return migrated
     
     def update_user_stats(self, user_id, guild_id=None):
         """Actualizar estadísticas de usuario"""
@@ -92,27 +563,155 @@ class BotDatabase:
             upsert=True
         )
     
+    def bulk_update_activity(self, user_activity, server_activity, conversation_activity=None, retry=()):
+        """Aplicar en bloque contadores acumulados.
+
+        `user_activity` y `server_activity` son {id: (mensajes, última actividad)};
+        `conversation_activity` son {servidor: (conversaciones, {usuarios})}, con la
+        clave None para las conversaciones fuera de servidores (DMs). `retry` son
+        escrituras que fallaron en un volcado anterior.
+
+        Devuelve las escrituras que no se aplicaron, como (colección, filtro,
+        actualización): solo esas se deben reintentar, porque repetir un $inc ya
+        aplicado contaría dos veces.
+        """
+        conversation_activity = conversation_activity or {}
+        writes = {"stats": [], "server_members": [], "users": [], "servers": []}
+        for collection, filter, update in retry:
+            writes[collection].append((filter, update))
+        failed = []
+
+        total_conversations = sum(count for count, _ in conversation_activity.values())
+        if total_conversations:
+            writes["stats"].append(({"_id": "global"}, {"$inc": {"total_conversations": total_conversations}}))
+        self._bulk_upsert("stats", writes["stats"], failed)
+        
+        # Registrar los pares servidor/usuario; solo los nuevos suman usuarios activos
+        for guild_id, (_, user_ids) in conversation_activity.items():
+            if guild_id:
+                writes["server_members"].extend(
+                    ({"guild_id": guild_id, "user_id": user_id}, {"$setOnInsert": {"guild_id": guild_id, "user_id": user_id}})
+                    for user_id in user_ids
+                )
+        new_members = {}
+        for index in self._bulk_upsert("server_members", writes["server_members"], failed):
+            guild_id = writes["server_members"][index][0]["guild_id"]
+            new_members[guild_id] = new_members.get(guild_id, 0) + 1
+        
+        server_updates = {}
+        for guild_id, (count, last_active) in server_activity.items():
+            server_updates[guild_id] = {"$inc": {"message_count": count}, "$max": {"last_active": last_active}}
+        for guild_id, (count, _) in conversation_activity.items():
+            if guild_id:
+                update = server_updates.setdefault(guild_id, {"$inc": {}})
+                update["$inc"]["conversation_count"] = count
+        for guild_id, count in new_members.items():
+            update = server_updates.setdefault(guild_id, {"$inc": {}})
+            update["$inc"]["active_users"] = count
+        
+        writes["users"].extend(
+            ({"user_id": user_id}, {"$inc": {"message_count": count}, "$max": {"last_active": last_active}})
+            for user_id, (count, last_active) in user_activity.items()
+        )
+        self._bulk_upsert("users", writes["users"], failed)
+        writes["servers"].extend(({"guild_id": guild_id}, update) for guild_id, update in server_updates.items())
+        self._bulk_upsert("servers", writes["servers"], failed)
+        return failed
+
+    def _bulk_upsert(self, collection, writes, failed):
+        """Upserts sin orden en `collection`; anota en `failed` los no aplicados y devuelve los índices insertados"""
+        if not writes:
+            return []
+        try:
+            result = getattr(self, collection).bulk_write(
+                [UpdateOne(filter, update, upsert=True) for filter, update in writes], ordered=False
+            )
+            return list(result.upserted_ids)
+        except BulkWriteError as e:
+            # Las demás operaciones del bloque sí se aplicaron
+            errors = {error["index"] for error in e.details["writeErrors"]}
+            print(f"Error actualizando {collection}: {len(errors)} de {len(writes)} escrituras fallaron, se reintentarán")
+            failed.extend((collection, *writes[index]) for index in sorted(errors))
+            return [upserted["index"] for upserted in e.details["upserted"]]
+        except PyMongoError as e:
+            print(f"Error actualizando {collection}, se reintentará: {e}")
+            failed.extend((collection, *write) for write in writes)
+            return []
+    
+    def ensure_stats_counters(self):
+        """Primera ejecución con contadores materializados: calcularlos desde el historial"""
+        if self.stats.find_one({"_id": "global"}) is not None:
+            return False
+        print("Calculando los contadores de estadísticas a partir del historial...")
+        self.rebuild_stats_counters()
+        return True
+    
+    def rebuild_stats_counters(self):
+        """Recalcular los contadores materializados a partir del historial guardado"""
+        total_conversations = 0
+        if self.layout == "ring":
+            # Solo cuenta los turnos que siguen en los arrays (como mucho HISTORY_RING_SIZE por usuario)
+            source = self.histories
+            pipeline = [
+                {"$unwind": "$turns"},
+                {"$group": {"_id": "$turns.guild_id", "count": {"$sum": 1}, "users": {"$addToSet": "$user_id"}}}
+            ]
+        else:
+            source = self.conversations
+            pipeline = [{"$group": {"_id": "$guild_id", "count": {"$sum": 1}, "users": {"$addToSet": "$user_id"}}}]
+        for group in source.aggregate(pipeline, allowDiskUse=True):
+            total_conversations += group["count"]
+            if not group["_id"]:
+                continue
+            self.server_members.bulk_write([
+                UpdateOne(
+                    {"guild_id": group["_id"], "user_id": user_id},
+                    {"$setOnInsert": {"guild_id": group["_id"], "user_id": user_id}},
+                    upsert=True
+                ) for user_id in group["users"]
+            ], ordered=False)
+            self.servers.update_one(
+                {"guild_id": group["_id"]},
+                {"$set": {"conversation_count": group["count"], "active_users": len(group["users"])}},
+                upsert=True
+            )
+        self.stats.update_one({"_id": "global"}, {"$set": {"total_conversations": total_conversations}}, upsert=True)
+        with self._snapshots_lock:
+            self._snapshots.clear()
+    
+    def _snapshot(self, key, loader):
+        """Servir una lectura reciente (STATS_SNAPSHOT_TTL) o recalcularla"""
+        with self._snapshots_lock:
+            value = self._snapshots.get(key)
+        if value is None:
+            value = loader()
+            with self._snapshots_lock:
+                self._snapshots.set(key, value)
+        return value
+    
     def get_global_stats(self):
         """Obtener estadísticas globales"""
-        total_conversations = self.conversations.count_documents({})
-        total_users = self.users.count_documents({})
-        total_servers = self.servers.count_documents({})
-        
-        return {
-            "total_conversations": total_conversations,
-            "total_users": total_users,
-            "total_servers": total_servers
-        }
+        def load():
+            global_counters = self.stats.find_one({"_id": "global"}) or {}
+            return {
+                "total_conversations": global_counters.get("total_conversations", 0),
+                "total_users": self.users.estimated_document_count(),
+                "total_servers": self.servers.estimated_document_count()
+            }
+        return self._snapshot("global", load)
     
     def get_server_stats(self, guild_id):
         """Obtener estadísticas de un servidor específico"""
-        server_messages = self.conversations.count_documents({"guild_id": str(guild_id)})
-        server_users = self.conversations.distinct("user_id", {"guild_id": str(guild_id)})
-        
-        return {
-            "server_messages": server_messages,
-            "active_users": len(server_users)
-        }
+        def load():
+            server_data = self.servers.find_one(
+                {"guild_id": str(guild_id)},
+                {"conversation_count": 1, "active_users": 1}
+            ) or {}
+            return {
+                "server_messages": server_data.get("conversation_count", 0),
+                "active_users": server_data.get("active_users", 0)
+            }
+        return self._snapshot(f"server:{guild_id}", load)
     
     def get_user_stats(self, user_id):
         """Obtener estadísticas de un usuario específico"""
@@ -124,3 +723,320 @@ class BotDatabase:
             "message_count": user_data.get("message_count", 0),
             "last_active": user_data.get("last_active")
         }
+
+
+class ConversationArchive:
+    """Archivo JSONL comprimido con gzip para las conversaciones caducadas.
+
+    Cada documento es una línea en JSON extendido de MongoDB (conserva fechas
+    e ObjectId). Tras cada lote se vacía el compresor y se sincroniza el
+    archivo, así que lo ya escrito es legible aunque el proceso se detenga.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        name = f"conversations-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.jsonl.gz"
+        self.path = os.path.join(directory, name)
+        self._file = open(self.path, "ab")
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb")
+
+    def write(self, documents):
+        for document in documents:
+            self._gzip.write(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS).encode("utf-8") + b"\n")
+        self._gzip.flush()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._gzip.close()
+        self._file.close()
+
+
+class ActivityBatcher:
+    """Acumula actividad de usuarios y servidores en memoria y la vuelca en bloque.
+
+    El volcado ocurre cada `interval` segundos, al alcanzar `max_events` eventos
+    o al llamar a `stop()`, así que las estadísticas son eventualmente consistentes.
+    """
+
+    def __init__(self, flush_callback, interval=STATS_FLUSH_INTERVAL, max_events=STATS_FLUSH_EVENTS):
+        self._flush_callback = flush_callback
+        self.interval = interval
+        self.max_events = max_events
+        self._users = {}
+        self._servers = {}
+        self._conversations = {}  # servidor -> (conversaciones, {usuarios})
+        self._retry = []  # escrituras que fallaron en el último volcado
+        self._events = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._pending_flush = None
+
+    @staticmethod
+    def _add(bucket, key, count, last_active):
+        previous_count, previous_active = bucket.get(key, (0, last_active))
+        bucket[key] = (previous_count + count, max(previous_active, last_active))
+
+    def record(self, user_id, guild_id=None):
+        """Registrar un mensaje del usuario (y de su servidor, si lo hay)"""
+        now = datetime.now()
+        self._add(self._users, str(user_id), 1, now)
+        if guild_id:
+            self._add(self._servers, str(guild_id), 1, now)
+        self._count_event()
+
+    def record_conversation(self, user_id, guild_id=None):
+        """Registrar una conversación guardada para los contadores materializados"""
+        self._add_conversations(str(guild_id) if guild_id else None, 1, {str(user_id)})
+        self._count_event()
+
+    def _add_conversations(self, guild_id, count, user_ids):
+        previous_count, previous_users = self._conversations.get(guild_id, (0, set()))
+        self._conversations[guild_id] = (previous_count + count, previous_users | user_ids)
+
+    def _count_event(self):
+        self._events += 1
+        if self._events >= self.max_events and (self._pending_flush is None or self._pending_flush.done()):
+            self._pending_flush = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Volcar a la base de datos todo lo acumulado hasta ahora"""
+        async with self._lock:
+            users, servers, conversations, retry = self._users, self._servers, self._conversations, self._retry
+            self._users, self._servers, self._conversations, self._retry, self._events = {}, {}, {}, [], 0
+            if not users and not servers and not conversations and not retry:
+                return
+            try:
+                # Solo se reintentan las escrituras que fallaron, no el volcado entero
+                self._retry = await self._flush_callback(users, servers, conversations, retry)
+            except Exception as e:
+                print(f"Error volcando estadísticas, se reintentará: {e}")
+                # Devolver lo no escrito para el próximo volcado
+                for user_id, (count, last_active) in users.items():
+                    self._add(self._users, user_id, count, last_active)
+                for guild_id, (count, last_active) in servers.items():
+                    self._add(self._servers, guild_id, count, last_active)
+                for guild_id, (count, user_ids) in conversations.items():
+                    self._add_conversations(guild_id, count, user_ids)
+                self._retry = retry
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        """Iniciar el volcado periódico en el event loop actual"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener el volcado periódico y escribir lo pendiente"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._pending_flush is not None:
+            await asyncio.gather(self._pending_flush, return_exceptions=True)
+        await self.flush()
+
+
+class AsyncBotDatabase:
+    """Variante asíncrona de BotDatabase.
+
+    Cada operación se ejecuta en un pool de hilos propio para que las llamadas
+    bloqueantes de pymongo no detengan el event loop del bot.
+    """
+
+    def __init__(self, database=None, max_workers=DB_EXECUTOR_WORKERS, history_cache=None, shared_history=False):
+        self.sync = database or BotDatabase()
+        self.history_cache = history_cache
+        # Con varios procesos escribiendo el historial (cluster), validar el caché contra MongoDB en cada lectura
+        self.shared_history = shared_history
+        self.summary_cache = LRUCache(HISTORY_CACHE_MAX_USERS, ttl=HISTORY_CACHE_TTL)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mongo")
+        self.activity = ActivityBatcher(self._flush_activity)
+        self._prune_task = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+            outcome = "ok"
+            return result
+        finally:
+            MONGO_LATENCY.observe(time.perf_counter() - start, method=func.__name__, outcome=outcome)
+
+    async def save_message(self, user_id, message, response, guild_id=None):
+        """Guardar conversación en la base de datos"""
+        timestamp = datetime.now()
+        result = await self._run(self.sync.save_message, user_id, message, response, guild_id, timestamp)
+        if self.history_cache is not None:
+            self.history_cache.append(user_id, {"message": message, "response": response, "timestamp": timestamp})
+        self.activity.record_conversation(user_id, guild_id)
+        return result
+
+    async def get_user_history(self, user_id, limit=None):
+        """Obtener historial de conversaciones de un usuario"""
+        return await self._run(self.sync.get_user_history, user_id, limit)
+
+    async def get_conversations_page(self, user_id, limit=50, cursor=None, since=None, truncate=None):
+        """Una página de conversaciones y el cursor de la siguiente"""
+        return await self._run(self.sync.get_conversations_page, user_id, limit, cursor, since, truncate)
+
+    async def get_history_turns(self, user_id, max_messages):
+        """Últimos turnos del usuario, servidos desde el caché cuando es posible"""
+        turns = self.history_cache.get(user_id) if self.history_cache is not None else None
+        if turns is not None and self.shared_history and not await self._history_current(user_id, turns):
+            # Otro worker guardó un turno o borró el historial: recargar también el resumen
+            self.history_cache.invalidate(user_id)
+            self.summary_cache.pop(str(user_id))
+            turns = None
+        if turns is None:
+            history = await self._run(self.sync.get_user_history, user_id, max_messages)
+            turns = [history_turn(conv) for conv in reversed(history)]
+            if self.history_cache is not None:
+                self.history_cache.set(user_id, turns)
+        return turns[-max_messages:]
+
+    async def _history_current(self, user_id, turns):
+        """Si el último turno en caché sigue siendo el último guardado en MongoDB"""
+        latest = await self._run(self.sync.get_latest_turn_time, user_id)
+        if not turns or latest is None:
+            return not turns and latest is None
+        # MongoDB guarda las fechas con precisión de milisegundos
+        cached = turns[-1]["timestamp"]
+        return latest == cached.replace(microsecond=cached.microsecond // 1000 * 1000)
+
+    async def clear_user_history(self, user_id):
+        """Limpiar historial de un usuario"""
+        if self.history_cache is not None:
+            self.history_cache.invalidate(user_id)
+        self.summary_cache.pop(str(user_id))
+        return await self._run(self.sync.clear_user_history, user_id)
+
+    async def get_history_summary(self, user_id):
+        """Obtener el resumen acumulado de un usuario (con caché)"""
+        summary = self.summary_cache.get(str(user_id))
+        if summary is None:
+            summary = await self._run(self.sync.get_history_summary, user_id)
+            self.summary_cache.set(str(user_id), summary)
+        return summary
+
+    async def save_history_summary(self, user_id, summary, until):
+        """Guardar el resumen acumulado de un usuario"""
+        await self._run(self.sync.save_history_summary, user_id, summary, until)
+        self.summary_cache.set(str(user_id), {"summary": summary, "until": until})
+
+    def record_activity(self, user_id, guild_id=None):
+        """Registrar actividad de usuario y servidor (escritura diferida en bloque)"""
+        self.activity.record(user_id, guild_id)
+
+    async def _flush_activity(self, user_activity, server_activity, conversation_activity, retry):
+        return await self._run(self.sync.bulk_update_activity, user_activity, server_activity, conversation_activity, retry)
+
+    async def get_global_stats(self):
+        """Obtener estadísticas globales"""
+        return await self._run(self.sync.get_global_stats)
+
+    async def get_server_stats(self, guild_id):
+        """Obtener estadísticas de un servidor específico"""
+        return await self._run(self.sync.get_server_stats, guild_id)
+
+    async def get_user_stats(self, user_id):
+        """Obtener estadísticas de un usuario específico"""
+        return await self._run(self.sync.get_user_stats, user_id)
+
+    async def prune_conversations(self, retention_days=HISTORY_RETENTION_DAYS, archive_dir=HISTORY_ARCHIVE_DIR):
+        """Archivar (opcional) y borrar las conversaciones más antiguas que la retención"""
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        return await self._run(self.sync.prune_conversations, cutoff, archive_dir)
+
+    async def _prune_periodically(self):
+        while True:
+            try:
+                removed = await self.prune_conversations()
+                if removed:
+                    print(f"🧹 {removed} conversaciones con más de {HISTORY_RETENTION_DAYS:g} días eliminadas")
+            except Exception as e:
+                print(f"Error aplicando la retención de conversaciones: {e}")
+            await asyncio.sleep(HISTORY_PRUNE_INTERVAL)
+
+    async def start(self, primary=True):
+        """Arrancar las tareas de fondo (volcado de estadísticas y retención).
+
+        Solo el proceso principal (`primary`; en un cluster, el worker 0) calcula
+        los contadores de estadísticas si aún no existen y aplica la retención.
+        """
+        if primary:
+            # Antes de empezar a volcar actividad, que el recálculo sobrescribiría
+            await self._run(self.sync.ensure_stats_counters)
+        self.activity.start()
+        if primary and HISTORY_RETENTION_DAYS > 0 and not USE_TTL_INDEX and self._prune_task is None:
+            self._prune_task = asyncio.create_task(self._prune_periodically())
+
+    async def close(self):
+        """Volcar estadísticas pendientes, esperar las operaciones y cerrar la conexión"""
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+            self._prune_task = None
+        await self.activity.stop()
+        await asyncio.to_thread(self._executor.shutdown, wait=True)
+        self.sync.client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Herramientas de mantenimiento de la base de datos de Lyla")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("indexes", help="Crear los índices de las consultas frecuentes")
+    subparsers.add_parser("rebuild-stats", help="Recalcular los contadores materializados de estadísticas")
+    explain_parser = subparsers.add_parser("explain", help="Mostrar el plan de cada consulta frecuente")
+    explain_parser.add_argument("--user", required=True, help="ID de usuario de ejemplo")
+    explain_parser.add_argument("--guild", required=True, help="ID de servidor de ejemplo")
+    explain_parser.add_argument("--limit", type=int, default=10, help="Límite de historial (MAX_HISTORY)")
+    prune_parser = subparsers.add_parser("prune", help="Archivar y borrar conversaciones más antiguas que la retención")
+    prune_parser.add_argument("--days", type=float, default=HISTORY_RETENTION_DAYS, help="Días de historial a conservar (HISTORY_RETENTION_DAYS)")
+    prune_parser.add_argument("--archive-dir", default=HISTORY_ARCHIVE_DIR, help="Directorio de los JSONL comprimidos (HISTORY_ARCHIVE_DIR)")
+    prune_parser.add_argument("--batch-size", type=int, default=HISTORY_PRUNE_BATCH, help="Conversaciones por lote")
+    prune_parser.add_argument("--dry-run", action="store_true", help="Solo contar las conversaciones caducadas")
+    migrate_parser = subparsers.add_parser("migrate-history", help="Convertir `conversations` al formato ring (HISTORY_LAYOUT=ring)")
+    migrate_parser.add_argument("--batch-size", type=int, default=500, help="Usuarios por escritura en bloque")
+    args = parser.parse_args()
+
+    if args.command == "prune" and args.days <= 0:
+        parser.error("indica --days o HISTORY_RETENTION_DAYS mayor que 0")
+
+    database = BotDatabase()
+    if args.command == "indexes":
+        print("✅ Índices verificados")
+    elif args.command == "rebuild-stats":
+        database.rebuild_stats_counters()
+        print(f"✅ Contadores recalculados: {database.get_global_stats()}")
+    elif args.command == "explain":
+        for name, plan in database.explain_hot_queries(args.user, args.guild, args.limit).items():
+            status = "⚠️ COLLSCAN" if "COLLSCAN" in plan["stages"] else "✅ índice"
+            if "FETCH" not in plan["stages"] and "COLLSCAN" not in plan["stages"]:
+                status += " (sin FETCH: solo índice)"
+            print(f"{name}: {status}")
+            print(f"    etapas: {' -> '.join(plan['stages'])}")
+            print(f"    índices: {', '.join(plan['indexes']) or '-'}")
+            print(f"    claves examinadas: {plan['keys_examined']}, "
+                  f"documentos examinados: {plan['docs_examined']}, devueltos: {plan['returned']}")
+    elif args.command == "prune":
+        cutoff = datetime.now() - timedelta(days=args.days)
+        if args.dry_run:
+            print(f"{database.count_expired_conversations(cutoff)} conversaciones anteriores a {cutoff:%Y-%m-%d %H:%M}")
+        else:
+            removed = database.prune_conversations(cutoff, args.archive_dir, args.batch_size)
+            destination = f", archivadas en {args.archive_dir}" if args.archive_dir else ""
+            print(f"✅ {removed} conversaciones eliminadas{destination}")
+    elif args.command == "migrate-history":
+        migrated = database.migrate_to_ring(args.batch_size)
+        print(f"✅ Historial de {migrated} usuarios copiado a `histories` (últimos {HISTORY_RING_SIZE} turnos)")
+        if database.layout != "ring":
+            print("Activa HISTORY_LAYOUT=ring para que el bot use el nuevo formato")
+
+
+if __name__ == "__main__":
+    main()
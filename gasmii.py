@@ -10,6 +10,10 @@ if not GOOGLE_AI_KEY:
     raise ValueError("GOOGLE_AI_KEY no está configurada en las variables de entorno")
 
 genai.configure(api_key=GOOGLE_AI_KEY)
+
+# Modelo más ligero al que se recurre si el principal falla o tiene el circuito abierto (vacío = sin respaldo)
+FALLBACK_MODEL_NAME = os.getenv("GEMINI_FALLBACK_MODEL", "gemini-1.5-flash-8b")
+
 text_generation_config = {
     "temperature": 0.9,
     "top_p": 1,
@@ -59,4 +63,18 @@ image_model = genai.GenerativeModel(
     generation_config=image_generation_config, 
     safety_settings=safety_settings,
     system_instruction=system_instruction
-)
\ No newline at end of file
+)
+
+# Modelos de respaldo: misma configuración sobre FALLBACK_MODEL_NAME
+fallback_text_model = genai.GenerativeModel(
+    model_name=FALLBACK_MODEL_NAME,
+    generation_config=text_generation_config,
+    safety_settings=safety_settings,
+    system_instruction=system_instruction
+) if FALLBACK_MODEL_NAME else None
+fallback_image_model = genai.GenerativeModel(
+    model_name=FALLBACK_MODEL_NAME,
+    generation_config=image_generation_config,
+    safety_settings=safety_settings,
+    system_instruction=system_instruction
+) if FALLBACK_MODEL_NAME else None
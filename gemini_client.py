@@ -0,0 +1,373 @@
+import asyncio
+import itertools
+import os
+import random
+import time
+from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
+from metrics import GEMINI_EVENTS, GEMINI_FIRST_CHUNK, GEMINI_LATENCY
+
+load_dotenv()
+
+# Límite de generaciones simultáneas contra Gemini y tiempo máximo por petición (segundos)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+# Reintentos ante errores transitorios, con espera exponencial y jitter (segundos)
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "2"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "0.5"))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "8"))
+# Fallos transitorios seguidos que abren el circuito de un modelo y segundos hasta volver a probarlo
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+# Segundos sin respuesta tras los que se lanza una segunda petición igual (0 = desactivado)
+GEMINI_HEDGE_AFTER = float(os.getenv("GEMINI_HEDGE_AFTER", "0"))
+# Segundos reservados al modelo de respaldo dentro de GEMINI_TIMEOUT
+GEMINI_FALLBACK_TIMEOUT = float(os.getenv("GEMINI_FALLBACK_TIMEOUT", "15"))
+
+# Errores del servicio que suelen resolverse solos: se reintentan y cuentan para el circuito
+TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+)
+
+
+class CircuitOpenError(Exception):
+    """El circuito del modelo está abierto: se falla sin llamar a Gemini"""
+
+
+# Marca de fin de una respuesta en streaming
+_STREAM_END = object()
+
+# Errores tras los que se recurre al modelo de respaldo
+FALLBACK_ERRORS = (CircuitOpenError,) + TRANSIENT_ERRORS
+
+
+def model_label(model):
+    """Nombre del modelo para las métricas ("models/gemini-1.5-flash" -> "gemini-1.5-flash")"""
+    return getattr(model, "model_name", "unknown").rsplit("/", 1)[-1]
+
+
+def _outcome(error):
+    """Resultado de una petición fallida para las métricas"""
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(error, CircuitOpenError):
+        return "rejected"
+    return "error"
+
+
+class CircuitBreaker:
+    """Circuito por modelo: cerrado, abierto tras `threshold` fallos transitorios seguidos
+    y semiabierto pasados `reset_timeout` segundos, cuando deja pasar una única petición
+    de prueba que lo vuelve a cerrar o abrir.
+    """
+
+    def __init__(self, threshold=GEMINI_BREAKER_THRESHOLD, reset_timeout=GEMINI_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        """Decidir si una petición puede salir; en semiabierto solo pasa una a la vez"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open" or self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        """Anotar un fallo transitorio; devuelve True si el circuito acaba de abrirse"""
+        self.failures += 1
+        self._probing = False
+        if self.opened_at is not None:
+            # Falló la petición de prueba: otro periodo abierto
+            self.opened_at = time.monotonic()
+            return False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            return True
+        return False
+
+    def release(self):
+        """Liberar la prueba de una petición cancelada sin resultado"""
+        self._probing = False
+
+
+class GeminiClient:
+    """Capa asíncrona sobre los modelos de gasmii.py.
+
+    Usa la API asíncrona del SDK para no bloquear el event loop de discord.py,
+    limita las generaciones concurrentes con un semáforo y aplica un timeout
+    que cubre todos los intentos de una petición, incluido el modelo de
+    respaldo. Los errores transitorios se reintentan con espera exponencial
+    y jitter; un circuito por modelo corta las llamadas mientras el servicio
+    está degradado y, si se indica un modelo de respaldo, la petición se
+    repite con él en los últimos `fallback_timeout` segundos del plazo. Con
+    `hedge_after` se lanza una segunda petición igual cuando la primera tarda
+    más de lo normal, hay un hueco libre en el semáforo y el modelo no viene
+    fallando, y se usa la que responda antes.
+    """
+
+    def __init__(self, max_concurrency=GEMINI_MAX_CONCURRENCY, timeout=GEMINI_TIMEOUT, retries=GEMINI_RETRIES,
+                 retry_base_delay=GEMINI_RETRY_BASE_DELAY, retry_max_delay=GEMINI_RETRY_MAX_DELAY,
+                 hedge_after=GEMINI_HEDGE_AFTER, breaker_threshold=GEMINI_BREAKER_THRESHOLD,
+                 breaker_reset=GEMINI_BREAKER_RESET, fallback_timeout=GEMINI_FALLBACK_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge_after = hedge_after
+        self.fallback_timeout = fallback_timeout
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.breakers = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def breaker(self, model):
+        label = model_label(model)
+        breaker = self.breakers.get(label)
+        if breaker is None:
+            breaker = self.breakers[label] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return breaker
+
+    def _backoff(self, attempt):
+        # Jitter completo: espera aleatoria entre 0 y el máximo exponencial
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+
+    def _deadlines(self, fallback):
+        """(plazo del modelo principal, plazo total); con respaldo, el principal deja sitio al respaldo"""
+        deadline = asyncio.get_running_loop().time() + self.timeout
+        if fallback is None:
+            return deadline, deadline
+        return deadline - min(self.fallback_timeout, self.timeout / 2), deadline
+
+    async def generate(self, model, prompt_parts, fallback=None, served=None):
+        """Generar una respuesta completa; con `fallback`, usarlo si el modelo principal no está disponible.
+
+        Si se pasa el dict `served`, se anota en served["fallback"] si respondió el modelo de respaldo.
+        """
+        if served is not None:
+            served["fallback"] = False
+        async with self._semaphore:
+            primary_deadline, deadline = self._deadlines(fallback)
+            try:
+                return await self._generate(model, prompt_parts, self.retries, primary_deadline)
+            except FALLBACK_ERRORS as e:
+                if fallback is None:
+                    raise
+                print(f"Gemini {model_label(model)} no disponible ({type(e).__name__}), usando {model_label(fallback)}")
+                GEMINI_EVENTS.inc(model=model_label(model), event="fallback")
+                if served is not None:
+                    served["fallback"] = True
+                return await self._generate(fallback, prompt_parts, 0, deadline)
+
+    async def _generate(self, model, prompt_parts, retries, deadline):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        label = model_label(model)
+        outcome = "error"
+        try:
+            response = await self._with_retries(
+                model, retries, deadline, lambda remaining: self._hedged(model, prompt_parts, remaining)
+            )
+            outcome = "ok"
+            return response
+        except Exception as e:
+            outcome = _outcome(e)
+            raise
+        finally:
+            GEMINI_LATENCY.observe(loop.time() - start, model=label, mode="generate", outcome=outcome)
+
+    async def _with_retries(self, model, retries, deadline, attempt_call):
+        """Ejecutar `attempt_call(segundos restantes)` respetando el circuito y reintentando errores transitorios"""
+        loop = asyncio.get_running_loop()
+        label = model_label(model)
+        breaker = self.breaker(model)
+        for attempt in itertools.count():
+            if not breaker.allow():
+                GEMINI_EVENTS.inc(model=label, event="rejected")
+                raise CircuitOpenError(f"Circuito abierto para {label}")
+            try:
+                result = await attempt_call(max(deadline - loop.time(), 0))
+            except TRANSIENT_ERRORS as e:
+                if breaker.record_failure():
+                    print(f"⚠️ Circuito abierto para {label} tras {breaker.failures} fallos seguidos")
+                    GEMINI_EVENTS.inc(model=label, event="circuit_open")
+                delay = self._backoff(attempt)
+                if attempt >= retries or loop.time() + delay >= deadline:
+                    raise
+                print(f"Error transitorio de Gemini ({type(e).__name__}), reintentando en {delay:.1f}s")
+                GEMINI_EVENTS.inc(model=label, event="retry")
+                await asyncio.sleep(delay)
+            except BaseException:
+                # Petición inválida, bloqueada o cancelada: no dice nada de la salud del servicio
+                breaker.release()
+                raise
+            else:
+                breaker.record_success()
+                return result
+
+    async def _call(self, model, prompt_parts, timeout):
+        return await asyncio.wait_for(
+            model.generate_content_async(prompt_parts, request_options={"timeout": timeout}),
+            timeout=timeout
+        )
+
+    async def _hedged(self, model, prompt_parts, timeout):
+        """Un intento; si tarda más de `hedge_after`, competir con una segunda petición igual"""
+        if not self.hedge_after or self.hedge_after >= timeout:
+            return await self._call(model, prompt_parts, timeout)
+        first = asyncio.ensure_future(self._call(model, prompt_parts, timeout))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            # Sin cobertura si el modelo viene fallando (429, sobrecarga) o no hay hueco en el semáforo
+            if not done and not self.breaker(model).failures and not self._semaphore.locked():
+                GEMINI_EVENTS.inc(model=model_label(model), event="hedge")
+                await self._semaphore.acquire()
+                hedge = asyncio.ensure_future(self._call(model, prompt_parts, timeout - self.hedge_after))
+                hedge.add_done_callback(lambda _: self._semaphore.release())
+                tasks.add(hedge)
+            failed = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            GEMINI_EVENTS.inc(model=model_label(model), event="hedge_won")
+                        return task.result()
+                    if failed is None or task is first:
+                        failed = task
+            # Fallaron las dos: se propaga el error de la petición original
+            return failed.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            first.cancel()
+
+    async def stream(self, model, prompt_parts, fallback=None, served=None):
+        """Generar una respuesta en streaming, devolviendo el texto de cada fragmento.
+
+        Solo se reintenta o se pasa al modelo de respaldo antes del primer
+        fragmento; una vez enviado texto al usuario, un error se propaga.
+        Los fragmentos se leen en una tarea aparte que libera el hueco del
+        semáforo en cuanto el modelo termina, aunque el consumidor siga
+        enviándolos a Discord. `served` funciona como en generate().
+        """
+        if served is not None:
+            served["fallback"] = False
+        queue = asyncio.Queue()
+        reader = asyncio.create_task(self._read_stream(model, prompt_parts, fallback, queue, served))
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # El consumidor puede dejar de leer antes de tiempo
+            reader.cancel()
+
+    async def _read_stream(self, model, prompt_parts, fallback, queue, served):
+        """Leer la respuesta en streaming hacia `queue`; termina con _STREAM_END o con la excepción"""
+        try:
+            await self._stream_chunks(model, prompt_parts, fallback, queue, served)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(_STREAM_END)
+
+    async def _stream_chunks(self, model, prompt_parts, fallback, queue, served):
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            deadline, total_deadline = self._deadlines(fallback)
+            if fallback is not None and self.breaker(model).state == "open":
+                GEMINI_EVENTS.inc(model=model_label(model), event="fallback")
+                model, deadline = fallback, total_deadline
+                if served is not None:
+                    served["fallback"] = True
+            label = model_label(model)
+            outcome = "error"
+            first_chunk = True
+
+            async def open_stream(remaining):
+                response = await asyncio.wait_for(
+                    model.generate_content_async(
+                        prompt_parts,
+                        stream=True,
+                        request_options={"timeout": remaining}
+                    ),
+                    timeout=remaining
+                )
+                chunks = response.__aiter__()
+                # Esperar también al primer fragmento: los errores del servidor suelen llegar ahí
+                try:
+                    first = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    first = None
+                return first, chunks
+
+            try:
+                try:
+                    chunk, chunks = await self._with_retries(model, self.retries, deadline, open_stream)
+                except FALLBACK_ERRORS as e:
+                    if fallback is None or model is fallback:
+                        raise
+                    print(f"Gemini {label} no disponible ({type(e).__name__}), usando {model_label(fallback)}")
+                    GEMINI_EVENTS.inc(model=label, event="fallback")
+                    GEMINI_LATENCY.observe(loop.time() - start, model=label, mode="stream", outcome=_outcome(e))
+                    # El respaldo usa lo que queda del plazo total
+                    model, label = fallback, model_label(fallback)
+                    if served is not None:
+                        served["fallback"] = True
+                    start = loop.time()
+                    deadline = total_deadline
+                    chunk, chunks = await self._with_retries(model, 0, deadline, open_stream)
+                # Una vez llega texto, la generación puede usar el plazo completo
+                deadline = total_deadline
+                while chunk is not None:
+                    if first_chunk:
+                        GEMINI_FIRST_CHUNK.observe(loop.time() - start, model=label)
+                        first_chunk = False
+                    if chunk.parts:
+                        queue.put_nowait(chunk.text)
+                    try:
+                        # El timeout cubre la generación completa, no cada fragmento
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=max(deadline - loop.time(), 0))
+                    except StopAsyncIteration:
+                        chunk = None
+                outcome = "ok"
+            except Exception as e:
+                outcome = _outcome(e)
+                raise
+            finally:
+                GEMINI_LATENCY.observe(loop.time() - start, model=label, mode="stream", outcome=outcome)
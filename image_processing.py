@@ -0,0 +1,77 @@
+import asyncio
+import io
+import os
+from dotenv import load_dotenv
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Sin Pillow solo se detecta el formato real
+    Image = None
+
+load_dotenv()
+
+# Lado máximo (px) útil para el modelo de visión y calidad JPEG al recodificar
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# Formatos que el modelo acepta tal cual (GIF siempre se convierte)
+MODEL_MIME_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+
+def sniff_mime_type(data):
+    """Detectar el tipo MIME real por los bytes mágicos (None si no es un formato conocido)"""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def preprocess_image(data, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY):
+    """Preparar una imagen para el modelo: formato real, un solo fotograma y tamaño acotado.
+
+    Devuelve el dict {"mime_type", "data"} que espera Gemini.
+    """
+    mime_type = sniff_mime_type(data) or "image/jpeg"
+    if Image is None:
+        return {"mime_type": mime_type, "data": data}
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Con el tamaño original: draft() cambia image.size
+            animated = getattr(image, "is_animated", False)
+            needs_resize = max(image.size) > max_side
+            if not animated and not needs_resize and mime_type in MODEL_MIME_TYPES:
+                return {"mime_type": mime_type, "data": data}
+            # JPEG: decodificar directamente a escala reducida
+            image.draft("RGB", (max_side, max_side))
+
+            # GIF/WEBP animado: quedarse con el primer fotograma
+            image.seek(0)
+            frame = ImageOps.exif_transpose(image)
+            if frame.mode in ("RGBA", "LA") or (frame.mode == "P" and "transparency" in frame.info):
+                # Aplanar la transparencia sobre fondo blanco
+                frame = frame.convert("RGBA")
+                background = Image.new("RGB", frame.size, (255, 255, 255))
+                background.paste(frame, mask=frame.getchannel("A"))
+                frame = background
+            else:
+                frame = frame.convert("RGB")
+            frame.thumbnail((max_side, max_side), Image.LANCZOS)
+
+            output = io.BytesIO()
+            frame.save(output, format="JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        print(f"Error preprocesando imagen, se envía sin cambios: {e}")
+        return {"mime_type": mime_type, "data": data}
+
+    return {"mime_type": "image/jpeg", "data": output.getvalue()}
+
+
+async def preprocess_images(images):
+    """Preprocesar varias imágenes en hilos, fuera del event loop"""
+    return await asyncio.gather(*(asyncio.to_thread(preprocess_image, data) for data in images))
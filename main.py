@@ -1,27 +1,32 @@
-import aiohttp
+import asyncio
+import math
 import os
+import signal
+import sys
+import time
 import io
-import json
 import re
 import discord
 import google.generativeai as genai
 from discord.ext import commands
 from discord import Embed, app_commands
-from gasmii import text_model, image_model
-from database import BotDatabase
+from gasmii import text_model, image_model, fallback_text_model, fallback_image_model, text_generation_config, image_generation_config, safety_settings, system_instruction
+from gemini_client import GeminiClient, CircuitOpenError
+from database import AsyncBotDatabase, format_history
+from cache import HistoryCache, ResponseCache, image_digest
+from context_builder import ContextBuilder, HISTORY_SUMMARY
+from sessions import SessionManager, SystemPromptCache, ERROR_REPLY_PREFIXES
+from turn_queue import TurnQueue
+from image_processing import preprocess_images
+from channel_registry import ChannelRegistry
+from message_filter import MessageFilter
+from web_server import start_web_server
+from send_scheduler import SendScheduler, split_message, split_stream, reply_file, DISCORD_MESSAGE_LIMIT, PRIORITY_HIGH, SEND_AS_FILE_CHARS
+from metrics import registry, DISCORD_SENDS, REPLY_LATENCY
+from attachments import AttachmentTooLarge, create_http_session, download_images, image_attachments, MAX_ATTACHMENT_BYTES
+from datetime import datetime
 from dotenv import load_dotenv
 
-# Inicializar base de datos
-try:
-    db = BotDatabase()
-    print("✅ Conexión a MongoDB establecida")
-except Exception as e:
-    print(f"❌ Error conectando a MongoDB: {e}")
-    db = None
-
-message_history = {}  # Mantenemos caché en memoria para rapidez
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="/", intents=intents, heartbeat_timeout=60)
 load_dotenv()
 
 GOOGLE_AI_KEY = os.getenv("GOOGLE_AI_KEY")
@@ -32,6 +37,177 @@ MAX_HISTORY = int(os.getenv("MAX_HISTORY"))
 if not GOOGLE_AI_KEY or not DISCORD_BOT_TOKEN:
     raise ValueError("Faltan variables de entorno requeridas: GOOGLE_AI_KEY y DISCORD_BOT_TOKEN")
 
+# Caché LRU de historial por usuario (delante de MongoDB o como única memoria sin DB)
+history_cache = HistoryCache(max_turns=MAX_HISTORY)
+# Prompt acotado por presupuesto de tokens (HISTORY_TOKEN_BUDGET)
+context_builder = ContextBuilder()
+# Historial como turnos user/model por usuario, con expulsión de sesiones inactivas
+sessions = SessionManager(context_builder)
+# Instrucciones del sistema en la caché de contexto de Gemini (GEMINI_CONTEXT_CACHE=true)
+prompt_cache = SystemPromptCache()
+# Usuarios con un resumen de historial en curso y tareas de fondo vivas
+summarizing_users = set()
+background_tasks = set()
+
+# Caché opcional de respuestas a preguntas sin historial (RESPONSE_CACHE_SIZE > 0)
+response_cache = ResponseCache()
+TEXT_MODEL_CONFIG = {
+    "model_name": text_model.model_name,
+    "generation_config": text_generation_config,
+    "safety_settings": safety_settings,
+    "system_instruction": system_instruction
+}
+IMAGE_MODEL_CONFIG = dict(TEXT_MODEL_CONFIG, model_name=image_model.model_name, generation_config=image_generation_config)
+
+# Respuestas en streaming: se edita el mensaje de Discord a medida que llegan fragmentos
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# Modo ligero: solo los intents necesarios y sin caché de miembros/presencias
+LEAN_MODE = os.getenv("LEAN_MODE", "false").lower() == "true"
+
+
+def memory_usage_mb():
+    """Memoria residente del proceso en MB"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0.0
+    # ru_maxrss es el pico: KB en Linux, bytes en macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+startup_memory_mb = memory_usage_mb()
+
+# Sharding: AUTO_SHARD usa AutoShardedBot; SHARD_COUNT/SHARD_IDS los fija el lanzador del cluster
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+AUTO_SHARD = os.getenv("AUTO_SHARD", "false").lower() == "true" or SHARD_IDS is not None
+# Cada cuántos segundos un worker del cluster publica su estado
+CLUSTER_STATUS_INTERVAL = float(os.getenv("CLUSTER_STATUS_INTERVAL", "15"))
+# Servidor web de estado dentro del event loop del bot (puerto PORT)
+WEB_SERVER = os.getenv("WEB_SERVER", "true").lower() == "true"
+
+# Inicializar base de datos
+try:
+    # En un cluster cada worker tiene su propio caché de historial: se valida contra MongoDB al leerlo
+    db = AsyncBotDatabase(history_cache=history_cache, shared_history=SHARD_IDS is not None)
+    print("✅ Conexión a MongoDB establecida")
+except Exception as e:
+    print(f"❌ Error conectando a MongoDB: {e}")
+    db = None
+
+gemini = GeminiClient()
+# Envíos a Discord con ritmo por canal (CHANNEL_SEND_RATE mensajes cada CHANNEL_SEND_WINDOW s)
+send_scheduler = SendScheduler()
+
+
+class LylaBot(commands.AutoShardedBot if AUTO_SHARD else commands.Bot):
+    http_session = None
+    # Diccionario compartido con el lanzador del cluster (cluster.py) e ID de este worker
+    status_board = None
+    worker_id = None
+    web_runner = None
+    _shutdown_task = None
+
+    async def setup_hook(self):
+        # El usuario del bot ya es conocido tras el login
+        message_filter.bot_id = self.user.id
+        # Procfile, Cloud Run y el lanzador del cluster paran el proceso con SIGTERM:
+        # cerrar igual que con Ctrl+C para volcar las estadísticas pendientes
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self._terminate)
+        except NotImplementedError:
+            pass  # Windows
+        # Sesión HTTP compartida para descargar adjuntos
+        self.http_session = create_http_session()
+        # Recoger los canales que activen o desactiven otros workers
+        self._channels_task = asyncio.create_task(chatbot_channels.watch())
+        await prompt_cache.start(
+            text_model.model_name, system_instruction,
+            {"text": text_generation_config, "image": image_generation_config}, safety_settings
+        )
+        if db:
+            # En un cluster solo el primer worker inicializa los contadores y aplica la retención
+            await db.start(primary=self.status_board is None or self.worker_id == 0)
+        if self.status_board is not None:
+            self._status_task = asyncio.create_task(self._publish_status())
+        elif WEB_SERVER:
+            # En un cluster la web la sirve el lanzador, no cada worker
+            self.web_runner = await start_web_server(status=worker_status, database=db)
+
+    async def _publish_status(self):
+        while True:
+            try:
+                # Las métricas viajan con el estado para que el lanzador las exponga en /metrics
+                status = dict(worker_status(), metrics=registry.collect())
+                # El dict del Manager es un proxy IPC: escribir fuera del event loop
+                await asyncio.to_thread(self.status_board.__setitem__, self.worker_id, status)
+            except Exception as e:
+                print(f"Error publicando estado del worker {self.worker_id}: {e}")
+            await asyncio.sleep(CLUSTER_STATUS_INTERVAL)
+
+    def _terminate(self):
+        if self._shutdown_task is None:
+            print("🛑 SIGTERM recibido, cerrando el bot...")
+            self._shutdown_task = asyncio.create_task(self.close())
+
+    async def __aexit__(self, *exc_info):
+        # run() solo espera el cierre de discord.py: esperar también al de close() iniciado por SIGTERM
+        await super().__aexit__(*exc_info)
+        if self._shutdown_task:
+            await self._shutdown_task
+
+    async def close(self):
+        if self.web_runner:
+            await self.web_runner.cleanup()
+        await super().close()
+        if self.http_session:
+            await self.http_session.close()
+        await prompt_cache.close()
+        # Volcar estadísticas pendientes y cerrar MongoDB una vez detenido el bot
+        if db:
+            await db.close()
+
+
+bot_options = {}
+if LEAN_MODE:
+    # Mensajes de servidor y DMs con su contenido; guild.member_count llega igualmente en GUILD_CREATE
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    bot_options.update(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+else:
+    intents = discord.Intents.all()
+if AUTO_SHARD:
+    bot_options.update(shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+bot = LylaBot(command_prefix="/", intents=intents, heartbeat_timeout=60, **bot_options)
+
+
+def worker_status():
+    """Estado de este proceso del bot (se agrega entre workers en /stats y /health)"""
+    ready = bot.is_ready()
+    return {
+        "ready": ready,
+        "bot_name": bot.user.name if bot.user else "Lyla",
+        "bot_id": bot.user.id if bot.user else None,
+        "shard_ids": list(bot.shard_ids) if AUTO_SHARD and bot.shard_ids else [bot.shard_id or 0],
+        "guild_count": len(bot.guilds) if ready else 0,
+        "user_count": sum(guild.member_count for guild in bot.guilds if guild.member_count) if ready else 0,
+        "latency": round(bot.latency * 1000, 2) if ready and not math.isnan(bot.latency) else None,
+        "updated": time.time()
+    }
+
 @bot.event
 async def on_ready():
     await bot.tree.sync()
@@ -67,21 +243,24 @@ async def on_ready():
     print(print_in_color(f"{bot.user} aka {bot.user.name} ¡se ha conectado a Discord!", "\033[1;97"))
     print(print_in_color(f"  Cargado comandos: {num_commands} comandos exitosos", "1;35"))
     print(print_in_color(f"      Enlace de invitación: {invite_link}", "1;36"))
+    print(print_in_color(f"      Memoria ({'modo ligero' if LEAN_MODE else 'intents completos'}): "
+                         f"{startup_memory_mb:.1f} MB al iniciar -> {memory_usage_mb():.1f} MB con {len(bot.guilds)} servidores", "1;33"))
 
 
 @bot.hybrid_command(name="reset", description="Borra el historial de mensajes del bot")
 async def reset(ctx):
-    global message_history
     user_id = ctx.author.id
     
+    # Los turnos en espera usarían el historial borrado y volverían a guardarlo
+    turn_queue.discard(user_id)
     # Limpiar caché local
-    if user_id in message_history:
-        del message_history[user_id]
+    history_cache.invalidate(user_id)
+    sessions.invalidate(user_id)
     
     # Limpiar base de datos
     if db:
         try:
-            result = db.clear_user_history(user_id)
+            result = await db.clear_user_history(user_id)
             await ctx.send(f"🤖 Historial borrado: {result.deleted_count} conversaciones eliminadas.")
         except Exception as e:
             await ctx.send(f"⚠️ Error al borrar historial: {e}")
@@ -106,8 +285,10 @@ async def stats(ctx):
         return
     
     try:
-        global_stats = db.get_global_stats()
-        user_stats = db.get_user_stats(ctx.author.id)
+        global_stats, user_stats = await asyncio.gather(
+            db.get_global_stats(),
+            db.get_user_stats(ctx.author.id)
+        )
         
         embed = Embed(title="📊 Estadísticas", color=0x00ff00)
         embed.add_field(name="🌍 Global", 
@@ -121,7 +302,7 @@ async def stats(ctx):
                        inline=True)
         
         if ctx.guild:
-            server_stats = db.get_server_stats(ctx.guild.id)
+            server_stats = await db.get_server_stats(ctx.guild.id)
             embed.add_field(name="🏠 Este servidor", 
                            value=f"Mensajes: {server_stats['server_messages']}\n"
                                  f"Usuarios activos: {server_stats['active_users']}", 
@@ -132,20 +313,10 @@ async def stats(ctx):
         await ctx.send(f"❌ Error obteniendo estadísticas: {e}")
 
     
-def create_chatbot_channels_file():
-    if not os.path.exists('chatbot_channels.json'):
-        with open('chatbot_channels.json', 'w') as file:
-            json.dump({}, file)
-
-create_chatbot_channels_file()
-
-chatbot_channels_file = 'chatbot_channels.json'
-chatbot_channels = {}
-
-# Load chatbot channels from chatbot_channels.json if it exists
-if os.path.exists(chatbot_channels_file):
-    with open(chatbot_channels_file, 'r') as file:
-        chatbot_channels = json.load(file)
+# Canales de chatbot cargados de chatbot_channels.json (se actualizan en vivo)
+chatbot_channels = ChannelRegistry()
+# Descarta en el camino rápido los mensajes que no van dirigidos al bot
+message_filter = MessageFilter(chatbot_channels)
 
 # Command to set or toggle chatbot channel
 @bot.hybrid_command(name="set_chatbot", description="Configurar o alternar canal del chatbot")
@@ -154,181 +325,352 @@ async def set_chatbot(ctx, channel: discord.TextChannel):
         await ctx.send("Este comando solo puede usarse en un servidor.")
         return
 
-    guild_id = str(ctx.guild.id)
-
-    with open(chatbot_channels_file, 'r') as file:
-        chatbot_channels = json.load(file)
-
-    if guild_id in chatbot_channels:
-        if chatbot_channels[guild_id]['channel_id'] == str(channel.id):
-            del chatbot_channels[guild_id]
-            await ctx.send(f"Las respuestas del chatbot han sido desactivadas para #{channel.name}.")
-        else:
-            chatbot_channels[guild_id] = {'channel_id': str(channel.id)}
-            await ctx.send(f"Las respuestas del chatbot han sido configuradas para #{channel.name}.")
-    else:
-        chatbot_channels[guild_id] = {'channel_id': str(channel.id)}
+    if await chatbot_channels.toggle(ctx.guild.id, channel.id):
         await ctx.send(f"Las respuestas del chatbot han sido configuradas para #{channel.name}.")
-
-    with open(chatbot_channels_file, 'w') as file:
-        json.dump(chatbot_channels, file, indent=4)
+    else:
+        await ctx.send(f"Las respuestas del chatbot han sido desactivadas para #{channel.name}.")
 
 # Event handler for new messages
 @bot.event
 async def on_message(message):
-    # Ignore messages sent by the bot
-    if message.author == bot.user:
-        return
     # Check if the bot is mentioned, the message is a DM, or it's in a designated chatbot channel
-    guild_id = str(message.guild.id) if message.guild else None
-    is_chatbot_channel = False
-
-    if guild_id and guild_id in chatbot_channels:
-        is_chatbot_channel = str(message.channel.id) == chatbot_channels[guild_id]['channel_id']
-
-    if bot.user.mentioned_in(message) or isinstance(message.channel, discord.DMChannel) or is_chatbot_channel:
+    if message_filter.accepts(message):
+        received = time.perf_counter()
         #Start Typing to seem like something happened
         cleaned_text = clean_discord_message(message.content)
 
         async with message.channel.typing():
             # Check for image attachments
-            if message.attachments:
+            images = image_attachments(message)
+            if images:
                 print("New Image Message FROM:" + str(message.author.id) + ": " + cleaned_text)
                 #Currently no chat history for images
-                for attachment in message.attachments:
-                    #these are the only image extentions it currently accepts
-                    if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']):
-                        await message.add_reaction('🎨')
-
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(attachment.url) as resp:
-                                if resp.status != 200:
-                                    await message.channel.send('No se pudo descargar la imagen.')
-                                    return
-                                image_data = await resp.read()
-                                response_text = await generate_response_with_image_and_text(image_data, cleaned_text)
-                                #Split the Message so discord does not get upset
-                                await split_and_send_messages(message, response_text, 1700)
-                                return
+                await message.add_reaction('🎨')
+
+                # Descargar todas las imágenes a la vez con la sesión compartida
+                results = await download_images(bot.http_session, images)
+                image_data = [result for result in results if isinstance(result, bytes)]
+                if not image_data:
+                    if any(isinstance(result, AttachmentTooLarge) for result in results):
+                        await send_scheduler.send(message.channel, f'La imagen supera el tamaño máximo de {MAX_ATTACHMENT_BYTES // (1024 * 1024)} MB.', PRIORITY_HIGH)
+                    else:
+                        await send_scheduler.send(message.channel, 'No se pudo descargar la imagen.', PRIORITY_HIGH)
+                    return
+                # Misma imagen y misma pregunta: responder desde caché sin preprocesar
+                cache_key = None
+                if response_cache.enabled:
+                    cache_key = response_cache.key(IMAGE_MODEL_CONFIG, cleaned_text, [image_digest(data) for data in image_data])
+                response_text = response_cache.get(cache_key) if cache_key else None
+                if response_text is None:
+                    # Formato real, un fotograma y resolución útil para el modelo
+                    image_parts = await preprocess_images(image_data)
+                    served = {}
+                    response_text = await generate_response_with_image_and_text(image_parts, cleaned_text, served)
+                    # La clave es del modelo principal: no guardar respuestas del modelo de respaldo
+                    if cache_key and not served.get("fallback") and not response_text.startswith(ERROR_REPLY_PREFIXES):
+                        response_cache.set(cache_key, response_text)
+                #Split the Message so discord does not get upset
+                await split_and_send_messages(message, response_text)
+                REPLY_LATENCY.observe(time.perf_counter() - received, kind="image")
+                return
             #Not an Image do text response
             else:
                 print("New Message FROM:" + str(message.author.id) + ": " + cleaned_text)
                 #Check for Keyword Reset
                 if "RESET" in cleaned_text or "REINICIAR" in cleaned_text.upper():
                     #End back message
-                    if message.author.id in message_history:
-                        del message_history[message.author.id]
-                    await message.channel.send("🤖 Historial reiniciado para el usuario: " + str(message.author.name))
-                    return
-                await message.add_reaction('💬')
-
-                # Actualizar estadísticas
-                if db:
-                    db.update_user_stats(message.author.id, message.guild.id if message.guild else None)
-                    if message.guild:
-                        db.update_server_stats(message.guild.id)
-                
-                #Check if history is disabled just send response
-                if(MAX_HISTORY == 0):
-                    response_text = await generate_response_with_text(cleaned_text)
-                    # Guardar en DB sin historial
+                    history_cache.invalidate(message.author.id)
+                    sessions.invalidate(message.author.id)
                     if db:
                         try:
-                            db.save_message(message.author.id, cleaned_text, response_text, message.guild.id if message.guild else None)
+                            await db.clear_user_history(message.author.id)
                         except Exception as e:
-                            print(f"Error guardando en DB: {e}")
-                    await split_and_send_messages(message, response_text, 1700)
-                    return;
-                
-                # Obtener historial (primero de DB, luego caché)
+                            print(f"Error borrando historial en DB: {e}")
+                    # Descartar turnos encolados que usarían el historial anterior
+                    turn_queue.discard(message.author.id)
+                    await send_scheduler.send(message.channel, "🤖 Historial reiniciado para el usuario: " + str(message.author.name), PRIORITY_HIGH)
+                    return
+                await message.add_reaction('💬')
+
+                # Actualizar estadísticas (se escriben en bloque en segundo plano)
                 if db:
-                    try:
-                        formatted_history = db.get_formatted_history(message.author.id, MAX_HISTORY)
-                        if formatted_history:
-                            response_text = await generate_response_with_text(formatted_history + "\n\n" + cleaned_text)
-                        else:
-                            response_text = await generate_response_with_text(cleaned_text)
-                        
-                        # Guardar conversación en DB
-                        db.save_message(message.author.id, cleaned_text, response_text, message.guild.id if message.guild else None)
-                    except Exception as e:
-                        print(f"Error con MongoDB, usando caché local: {e}")
-                        # Fallback al sistema anterior
-                        update_message_history(message.author.id, cleaned_text)
-                        response_text = await generate_response_with_text(get_formatted_message_history(message.author.id))
-                        update_message_history(message.author.id, response_text)
-                else:
-                    # Sistema anterior como fallback
-                    update_message_history(message.author.id, cleaned_text)
-                    response_text = await generate_response_with_text(get_formatted_message_history(message.author.id))
-                    update_message_history(message.author.id, response_text)
+                    db.record_activity(message.author.id, message.guild.id if message.guild else None)
                 
-                await split_and_send_messages(message, response_text, 1700)
+                # Encolar el turno: se sirve en orden y las ráfagas se agrupan en una sola generación
+                turn_queue.submit(message.author.id, (message, cleaned_text, received), group=message.channel.id)
 
 
-    
+async def handle_text_turn(batch):
+    """
+    Answer one queued turn. A burst of messages from the same user in the same channel
+    arrives here as a single batch: their texts are joined and the reply goes to the last one.
+    """
+    message = batch[-1][0]
+    cleaned_text = "\n".join(text for _, text, _ in batch)
+    await answer_text_turn(message, cleaned_text)
+    # Desde el primer mensaje de la ráfaga, incluida la espera en la cola
+    REPLY_LATENCY.observe(time.perf_counter() - batch[0][2], kind="text")
+
+
+async def answer_text_turn(message, cleaned_text):
+    """
+    Generate and send the reply to a (possibly coalesced) text turn, using the stored history.
+    """
+    async with message.channel.typing():
+        #Check if history is disabled just send response
+        if(MAX_HISTORY == 0):
+            response_text = await respond_with_text(message, cleaned_text, cacheable=True)
+            # Guardar en DB sin historial
+            if db:
+                try:
+                    await db.save_message(message.author.id, cleaned_text, response_text, message.guild.id if message.guild else None)
+                except Exception as e:
+                    print(f"Error guardando en DB: {e}")
+            return;
+
+        # Obtener historial (primero de DB, luego caché)
+        if db:
+            try:
+                turns = await db.get_history_turns(message.author.id, MAX_HISTORY)
+                summary = await db.get_history_summary(message.author.id) if HISTORY_SUMMARY else None
+            except Exception as e:
+                print(f"Error con MongoDB, usando caché local: {e}")
+                # Fallback al historial en memoria
+                await respond_with_local_history(message, cleaned_text)
+                return
+
+            # Recortar el historial al presupuesto de tokens, descartando primero lo más antiguo
+            summary_text = summary["summary"] if summary else None
+            contents, evicted = sessions.build(message.author.id, turns, cleaned_text, summary_text)
+            # Sin historial en el prompt la respuesta puede servirse desde caché
+            response_text = await respond_with_text(message, cleaned_text, contents, cacheable=len(contents) == 1 and not summary_text)
+
+            # Guardar conversación en DB
+            try:
+                await db.save_message(message.author.id, cleaned_text, response_text, message.guild.id if message.guild else None)
+            except Exception as e:
+                print(f"Error guardando en DB: {e}")
+
+            # Resumir en segundo plano los turnos que ya no caben en el prompt
+            if HISTORY_SUMMARY and evicted:
+                task = asyncio.create_task(summarize_history(message.author.id, summary, evicted))
+                background_tasks.add(task)
+                task.add_done_callback(background_tasks.discard)
+        else:
+            # Sin base de datos el caché es la única memoria
+            await respond_with_local_history(message, cleaned_text)
+
+def merge_turn_items(older, newer):
+    """Unir dos mensajes en espera del mismo canal: texto de ambos, respuesta al más reciente"""
+    return (newer[0], older[1] + "\n" + newer[1], older[2])
+
+
+# Cola ordenada de turnos por usuario (las ráfagas se agrupan por canal)
+turn_queue = TurnQueue(handle_text_turn, merge=merge_turn_items)
+
+
+def cache_requests():
+    """Aciertos y fallos de cada caché para /metrics"""
+    caches = {"history": history_cache, "response": response_cache, "session": sessions}
+    if db:
+        caches["summary"] = db.summary_cache
+    values = {}
+    for name, cache in caches.items():
+        values[(name, "hit")] = cache.hits
+        values[(name, "miss")] = cache.misses
+    return values
+
+
+registry.callback("lyla_turn_queue_depth", "Mensajes en espera en las colas de turnos", lambda: turn_queue.depth)
+registry.callback(
+    "lyla_turn_queue_events_total", "Mensajes encolados, turnos atendidos y mensajes unidos o descartados",
+    lambda: {("submitted",): turn_queue.submitted, ("batches",): turn_queue.batches,
+             ("merged",): turn_queue.merged, ("dropped",): turn_queue.dropped},
+    type="counter", labelnames=("event",)
+)
+registry.callback(
+    "lyla_messages_filtered_total", "Mensajes de on_message atendidos o descartados por el filtro rápido",
+    lambda: {("handled",): message_filter.handled, ("filtered",): message_filter.filtered},
+    type="counter", labelnames=("result",)
+)
+registry.callback("lyla_cache_requests_total", "Consultas a las cachés por resultado", cache_requests, type="counter", labelnames=("cache", "result"))
+registry.callback("lyla_send_queue_depth", "Mensajes pendientes en las colas de envío por canal", lambda: send_scheduler.depth)
+registry.callback("lyla_send_paced_total", "Esperas para respetar el límite de envíos por canal", lambda: send_scheduler.paced, type="counter")
+registry.callback(
+    "lyla_gemini_circuit_open", "Circuitos de Gemini abiertos (1) o cerrados (0) por modelo",
+    lambda: {(name,): int(breaker.state == "open") for name, breaker in gemini.breakers.items()}, labelnames=("model",)
+)
+registry.callback("lyla_chat_sessions", "Sesiones de chat por usuario en memoria", lambda: len(sessions))
+registry.callback("lyla_process_memory_mb", "Memoria residente del proceso en MB", memory_usage_mb)
 
 #ry-------------------------------------------------
 
-async def generate_response_with_text(message_text):
+async def generate_response_with_text(message_text, contents=None, served=None):
     try:
-        prompt_parts = [message_text]
+        prompt_parts = contents or [message_text]
         print(f"Procesando texto: {message_text[:100]}...")
-        response = text_model.generate_content(prompt_parts)
+        response = await gemini.generate(prompt_cache.model("text", text_model), prompt_parts, fallback=fallback_text_model, served=served)
         if hasattr(response, '_error') and response._error:
             return f"❌ Error: {response._error}"
         return response.text
+    except asyncio.TimeoutError:
+        print(f"Tiempo de espera agotado generando respuesta de texto ({gemini.timeout}s)")
+        return "⏱️ La respuesta tardó demasiado, inténtalo de nuevo."
+    except CircuitOpenError:
+        print("Gemini no disponible: circuito abierto")
+        return "⏳ El servicio de IA está saturado ahora mismo, inténtalo en unos segundos."
     except Exception as e:
         print(f"Error generando respuesta de texto: {e}")
         return "❌ Ocurrió un error al procesar tu mensaje."
 
-async def generate_response_with_image_and_text(image_data, text):
+async def respond_with_text(message_system, message_text, contents=None, cacheable=False):
+    """
+    Generate a text response and post it, streaming it when STREAM_RESPONSES is enabled.
+    `contents` is the structured chat history ending with message_text (defaults to message_text alone).
+    History-free prompts (cacheable=True) are served from the response cache when possible;
+    replies from the fallback model are never cached, since the key belongs to the primary model.
+    """
+    cache_key = response_cache.key(TEXT_MODEL_CONFIG, message_text) if cacheable and response_cache.enabled else None
+    response_text = response_cache.get(cache_key) if cache_key else None
+    if response_text is not None:
+        await split_and_send_messages(message_system, response_text)
+        return response_text
+
+    served = {}
+    if STREAM_RESPONSES:
+        response_text = await stream_response_with_text(message_system, message_text, contents, served)
+    else:
+        response_text = await generate_response_with_text(message_text, contents, served)
+        #Split the Message so discord does not get upset
+        await split_and_send_messages(message_system, response_text)
+    if cache_key and not served.get("fallback") and not response_text.startswith(ERROR_REPLY_PREFIXES):
+        response_cache.set(cache_key, response_text)
+    return response_text
+
+async def stream_response_with_text(message_system, message_text, contents=None, served=None):
+    try:
+        print(f"Procesando texto (streaming): {message_text[:100]}...")
+        chunks = gemini.stream(prompt_cache.model("text", text_model), contents or [message_text], fallback=fallback_text_model, served=served)
+        response_text = await stream_and_send_messages(message_system, chunks)
+        if response_text.strip():
+            return response_text
+        # Respuesta bloqueada o sin texto: no se publicó nada
+        print("La respuesta en streaming llegó vacía")
+        response_text = "❌ No pude generar una respuesta a tu mensaje."
+    except asyncio.TimeoutError:
+        print(f"Tiempo de espera agotado generando respuesta de texto ({gemini.timeout}s)")
+        response_text = "⏱️ La respuesta tardó demasiado, inténtalo de nuevo."
+    except CircuitOpenError:
+        print("Gemini no disponible: circuito abierto")
+        response_text = "⏳ El servicio de IA está saturado ahora mismo, inténtalo en unos segundos."
+    except Exception as e:
+        print(f"Error generando respuesta de texto: {e}")
+        response_text = "❌ Ocurrió un error al procesar tu mensaje."
+    await send_scheduler.send(message_system.channel, response_text, PRIORITY_HIGH)
+    return response_text
+
+async def generate_response_with_image_and_text(image_parts, text, served=None):
     try:
-        image_parts = [{"mime_type": "image/jpeg", "data": image_data}]
-        prompt_parts = [image_parts[0], f"\n{text if text else '¿Qué hay en esta imagen?'}"]
-        response = image_model.generate_content(prompt_parts)
+        prompt_parts = image_parts + [f"\n{text if text else '¿Qué hay en esta imagen?'}"]
+        response = await gemini.generate(prompt_cache.model("image", image_model), prompt_parts, fallback=fallback_image_model, served=served)
         if hasattr(response, '_error') and response._error:
             return f"❌ Error: {response._error}"
         return response.text
+    except asyncio.TimeoutError:
+        print(f"Tiempo de espera agotado procesando imagen ({gemini.timeout}s)")
+        return "⏱️ La imagen tardó demasiado en procesarse, inténtalo de nuevo."
+    except CircuitOpenError:
+        print("Gemini no disponible: circuito abierto")
+        return "⏳ El servicio de IA está saturado ahora mismo, inténtalo en unos segundos."
     except Exception as e:
         print(f"Error procesando imagen: {e}")
         return "❌ No pude procesar la imagen."
 
 #---------------------------------------------Message History-------------------------------------------------
-def update_message_history(user_id, text):
-    # Check if user_id already exists in the dictionary
-    if user_id in message_history:
-        # Append the new message to the user's message list
-        message_history[user_id].append(text)
-        # If there are more than 12 messages, remove the oldest one
-        if len(message_history[user_id]) > MAX_HISTORY:
-            message_history[user_id].pop(0)
-    else:
-        # If the user_id does not exist, create a new entry with the message
-        message_history[user_id] = [text]
+async def respond_with_local_history(message_system, text):
+    """
+    Respond using only the in-memory history cache and remember the new turn.
+    """
+    user_id = message_system.author.id
+    contents, _ = sessions.build(user_id, history_cache.get(user_id) or [], text)
+    response_text = await respond_with_text(message_system, text, contents)
+    history_cache.append(user_id, {"message": text, "response": response_text, "timestamp": datetime.now()}, create=True)
+    return response_text
 
-def get_formatted_message_history(user_id):
+async def summarize_history(user_id, summary, evicted):
     """
-    Function to return the message history for a given user_id with two line breaks between each message.
+    Fold turns evicted from the prompt into the user's rolling summary stored in MongoDB.
     """
-    if user_id in message_history:
-        # Join the messages with two line breaks
-        return '\n\n'.join(message_history[user_id])
-    else:
-        return "No messages found for this user."
+    until = summary["until"] if summary else None
+    pending = [turn for turn in evicted if until is None or turn["timestamp"] > until]
+    if not pending or user_id in summarizing_users:
+        return
+    summarizing_users.add(user_id)
+    try:
+        previous = summary["summary"] if summary and summary["summary"] else "(sin resumen previo)"
+        prompt = (
+            "Actualiza el resumen de esta conversación en pocas frases, conservando datos, "
+            "preferencias y temas importantes del usuario. Responde solo con el resumen.\n\n"
+            f"Resumen actual: {previous}\n\n"
+            f"Nuevos mensajes:\n{format_history(pending)}"
+        )
+        response = await gemini.generate(prompt_cache.model("text", text_model), [prompt], fallback=fallback_text_model)
+        await db.save_history_summary(user_id, response.text.strip(), pending[-1]["timestamp"])
+    except Exception as e:
+        print(f"Error resumiendo historial: {e}")
+    finally:
+        summarizing_users.discard(user_id)
 
 #---------------------------------------------Sending Messages-------------------------------------------------
-async def split_and_send_messages(message_system, text, max_length):
-
-    # Split the string into parts
-    messages = []
-    for i in range(0, len(text), max_length):
-        sub_message = text[i:i+max_length]
-        messages.append(sub_message)
+async def split_and_send_messages(message_system, text, max_length=DISCORD_MESSAGE_LIMIT):
+    """
+    Send a reply through the channel's send queue, split on paragraph and code-block boundaries.
+    Replies longer than SEND_AS_FILE_CHARS go out as a single file attachment instead.
+    """
+    if len(text) > SEND_AS_FILE_CHARS:
+        await send_scheduler.send(message_system.channel, "📄 La respuesta es larga, te la envío como archivo.", file=reply_file(text))
+        return
+    await send_scheduler.send_all(message_system.channel, split_message(text, max_length))
 
-    # Send each part as a separate message
-    for string in messages:
-        await message_system.channel.send(string)
+async def stream_and_send_messages(message_system, chunks, max_length=DISCORD_MESSAGE_LIMIT):
+    """
+    Post a streamed response as it arrives: the current Discord message is edited at most
+    once every STREAM_EDIT_INTERVAL seconds and, past max_length characters, the text rolls
+    over into new messages split like split_and_send_messages does. Returns the full text.
+    """
+    loop = asyncio.get_running_loop()
+    text = ""
+    tail = ""  # Text of the message still being edited
+    current = None  # Discord message being edited
+    last_edit = 0.0
+
+    async def publish(content):
+        nonlocal current
+        if current is None:
+            current = await send_scheduler.send(message_system.channel, content)
+        else:
+            await current.edit(content=content)
+            DISCORD_SENDS.inc(action="edit")
+
+    async for chunk in chunks:
+        text += chunk
+        tail += chunk
+        # Roll over into new messages on paragraph and code-block boundaries
+        if len(tail) > max_length:
+            finished, tail = split_stream(tail, max_length)
+            for part in finished:
+                await publish(part)
+                current = None
+            last_edit = loop.time()
+        if tail.strip() and loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+            await publish(tail)
+            last_edit = loop.time()
+
+    for index, part in enumerate(split_message(tail, max_length)):
+        if index:
+            current = None
+        await publish(part)
+    return text
 
 def clean_discord_message(input_string):
     # Create a regular expression pattern to match text between < and >
@@ -0,0 +1,32 @@
+class MessageFilter:
+    """Filtro rápido para on_message.
+
+    Decide con comparaciones de enteros y búsquedas en sets si un mensaje va
+    dirigido al bot (canal de chatbot, DM o mención), antes de crear strings
+    o recorrer estructuras más caras. Cuenta los mensajes descartados y los
+    atendidos.
+    """
+
+    __slots__ = ("registry", "bot_id", "filtered", "handled")
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.bot_id = None
+        self.filtered = 0
+        self.handled = 0
+
+    def accepts(self, message):
+        """True si el bot debe atender el mensaje"""
+        bot_id = self.bot_id
+        # Ignore messages sent by the bot
+        if bot_id is None or message.author.id == bot_id:
+            self.filtered += 1
+            return False
+        if (message.channel.id in self.registry.channel_ids
+                or message.guild is None
+                or message.mention_everyone
+                or (message.mentions and any(user.id == bot_id for user in message.mentions))):
+            self.handled += 1
+            return True
+        self.filtered += 1
+        return False
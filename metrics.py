@@ -0,0 +1,188 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# Límites (segundos) de los buckets de los histogramas de latencia
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador acumulado por combinación de etiquetas"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """Histograma acumulativo al estilo Prometheus (buckets, suma y total)"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        series = self._values.get(key)
+        if series is None:
+            # Conteos por bucket (el último es +Inf), suma y total
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Medir la duración de un bloque `with`, aunque termine con una excepción"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(bound)), cumulative))
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class CallbackMetric:
+    """Métrica leída en el momento de exponerla (profundidad de colas, aciertos de caché...).
+
+    El callback devuelve un número o un dict {tupla de etiquetas: valor}.
+    """
+
+    def __init__(self, name, help, type, callback, labelnames=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labelnames = tuple(labelnames)
+        self._callback = callback
+
+    def samples(self):
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class MetricsRegistry:
+    """Conjunto de métricas de un proceso, exportables en formato de texto de Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica duplicada: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name, help, callback, type="gauge", labelnames=()):
+        return self._register(CallbackMetric(name, help, type, callback, labelnames))
+
+    def collect(self):
+        """Familias de métricas como datos simples (se pueden enviar entre procesos)"""
+        families = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Error leyendo la métrica {metric.name}: {e}")
+                continue
+            families.append({"name": metric.name, "help": metric.help, "type": metric.type, "samples": samples})
+        return families
+
+
+def merge_families(families, extra, **labels):
+    """Añadir a `families` las muestras de otro proceso, distinguidas por `labels`"""
+    by_name = {family["name"]: family for family in families}
+    for family in extra:
+        target = by_name.get(family["name"])
+        if target is None:
+            target = by_name[family["name"]] = dict(family, samples=[])
+            families.append(target)
+        target["samples"] = target["samples"] + [
+            (name, dict(sample_labels, **labels), value) for name, sample_labels, value in family["samples"]
+        ]
+    return families
+
+
+def render(families):
+    """Formato de exposición de texto de Prometheus (versión 0.0.4)"""
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family['name']} {family['help']}")
+        lines.append(f"# TYPE {family['name']} {family['type']}")
+        for name, labels, value in family["samples"]:
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# Registro del proceso y métricas del camino crítico
+registry = MetricsRegistry()
+
+GEMINI_LATENCY = registry.histogram(
+    "lyla_gemini_request_seconds", "Duración de las peticiones a Gemini", ("model", "mode", "outcome")
+)
+GEMINI_FIRST_CHUNK = registry.histogram(
+    "lyla_gemini_first_chunk_seconds", "Tiempo hasta el primer fragmento en streaming", ("model",)
+)
+GEMINI_EVENTS = registry.counter(
+    "lyla_gemini_events_total", "Reintentos, circuitos abiertos, peticiones rechazadas, coberturas y fallbacks de Gemini",
+    ("model", "event")
+)
+MONGO_LATENCY = registry.histogram(
+    "lyla_mongo_operation_seconds", "Duración de las operaciones de MongoDB (incluye la espera en el pool)", ("method", "outcome")
+)
+REPLY_LATENCY = registry.histogram(
+    "lyla_reply_seconds", "Tiempo desde la recepción del mensaje hasta enviar la respuesta", ("kind",)
+)
+DISCORD_SENDS = registry.counter(
+    "lyla_discord_messages_total", "Mensajes enviados o editados en Discord", ("action",)
+)
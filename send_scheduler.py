@@ -0,0 +1,201 @@
+import asyncio
+import heapq
+import io
+import itertools
+import os
+import re
+from collections import deque
+import discord
+from dotenv import load_dotenv
+from metrics import DISCORD_SENDS
+
+load_dotenv()
+
+# Límite de caracteres de un mensaje de Discord
+DISCORD_MESSAGE_LIMIT = 2000
+# Respuestas más largas se envían como un único archivo adjunto
+SEND_AS_FILE_CHARS = int(os.getenv("SEND_AS_FILE_CHARS", "8000"))
+# Discord admite unos 5 mensajes cada 5 segundos por canal
+CHANNEL_SEND_RATE = int(os.getenv("CHANNEL_SEND_RATE", "5"))
+CHANNEL_SEND_WINDOW = float(os.getenv("CHANNEL_SEND_WINDOW", "5"))
+
+# Prioridades: avisos y errores antes que las respuestas
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+FENCE_CLOSE = "\n```"
+# Espacio para reabrir un bloque de código ("```" + lenguaje + salto de línea)
+FENCE_OPEN_MAX = 24
+PARAGRAPH_BREAK = re.compile(r"(?<=\n\n)")
+WORD_BREAK = re.compile(r"(?<= )")
+
+
+def _pieces(text, limit):
+    """Trozos de como mucho `limit` caracteres: párrafos, y si no caben, líneas, palabras o cortes fijos"""
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        if len(paragraph) <= limit:
+            yield paragraph
+            continue
+        for line in paragraph.splitlines(keepends=True):
+            if len(line) <= limit:
+                yield line
+                continue
+            for word in WORD_BREAK.split(line):
+                for start in range(0, len(word), limit):
+                    yield word[start:start + limit]
+
+
+def _fence_after(piece, fence):
+    """Bloque de código abierto tras `piece` (la línea de apertura, o None)"""
+    for line in piece.splitlines():
+        stripped = line.strip()
+        if stripped.startswith("```"):
+            fence = None if fence else stripped[:FENCE_OPEN_MAX - 1]
+    return fence
+
+
+def _pack(text, limit):
+    """Agrupar los trozos de `text` en mensajes; devuelve (mensajes cerrados, último mensaje sin cerrar, bloque abierto)"""
+    budget = limit - len(FENCE_CLOSE)
+    chunks = []
+    current = ""
+    fence = None
+    for piece in _pieces(text, budget - FENCE_OPEN_MAX):
+        if current and len(current) + len(piece) > budget:
+            chunks.append(_close(current, fence))
+            current = fence + "\n" if fence else ""
+        current += piece
+        fence = _fence_after(piece, fence)
+    return chunks, current, fence
+
+
+def _close(chunk, fence):
+    if fence:
+        chunk = chunk.rstrip("\n") + FENCE_CLOSE
+    return chunk.rstrip()
+
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Partir un texto en mensajes de hasta `limit` caracteres.
+
+    Agrupa párrafos completos mientras quepan y solo corta líneas o palabras
+    cuando un párrafo no cabe entero. Si el corte cae dentro de un bloque de
+    código, lo cierra al final del mensaje y lo reabre con el mismo lenguaje
+    en el siguiente.
+    """
+    chunks, current, fence = _pack(text, limit)
+    chunks.append(_close(current, fence))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def split_stream(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Partir el texto recibido hasta ahora de una respuesta en streaming.
+
+    Devuelve (mensajes completos, resto): el resto es el último mensaje aún
+    abierto, sin recortar, al que se irán añadiendo los fragmentos siguientes
+    (empieza reabriendo el bloque de código si el corte cayó dentro de uno).
+    """
+    chunks, current, _ = _pack(text, limit)
+    return [chunk for chunk in chunks if chunk.strip()], current
+
+
+def reply_file(text, filename="respuesta.md"):
+    """Archivo adjunto con el texto completo de una respuesta demasiado larga"""
+    return discord.File(io.BytesIO(text.encode("utf-8")), filename=filename)
+
+
+class SendScheduler:
+    """Cola de envíos por canal con ritmo y prioridades.
+
+    Cada canal tiene su propia cola y envía como mucho `rate` mensajes cada
+    `window` segundos, para no provocar respuestas 429 que retrasen al resto
+    de conversaciones del canal. Dentro de un canal salen antes los mensajes
+    de mayor prioridad y, a igual prioridad, las respuestas en el orden en que
+    se encolaron: las partes de una respuesta larga salen seguidas, sin
+    mezclarse con las de otra.
+    """
+
+    def __init__(self, rate=CHANNEL_SEND_RATE, window=CHANNEL_SEND_WINDOW):
+        self.rate = rate
+        self.window = window
+        self._queues = {}
+        self._workers = {}
+        self._sent_at = {}
+        self._order = itertools.count()
+        self.sent = 0
+        self.paced = 0
+
+    @property
+    def depth(self):
+        """Mensajes pendientes de enviar en todos los canales"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def send(self, channel, content=None, priority=PRIORITY_NORMAL, part=0, reply=None, **kwargs):
+        """Encolar un mensaje (la parte `part` de la respuesta `reply`); devuelve un futuro con el mensaje enviado"""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(channel.id, [])
+        order = next(self._order)
+        reply = order if reply is None else reply
+        heapq.heappush(queue, ((priority, reply, part), order, channel, content, kwargs, future))
+        if channel.id not in self._workers:
+            self._workers[channel.id] = asyncio.create_task(self._work(channel.id))
+        return future
+
+    async def send_all(self, channel, contents, priority=PRIORITY_NORMAL):
+        """Enviar varias partes de una respuesta, en orden; devuelve los mensajes enviados"""
+        reply = next(self._order)
+        futures = [self.send(channel, content, priority, part, reply) for part, content in enumerate(contents)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    async def _pace(self, channel_id):
+        # Ventana deslizante con los envíos recientes del canal
+        loop = asyncio.get_running_loop()
+        sent_at = self._sent_at.setdefault(channel_id, deque())
+        while True:
+            now = loop.time()
+            while sent_at and now - sent_at[0] >= self.window:
+                sent_at.popleft()
+            if len(sent_at) < self.rate:
+                sent_at.append(now)
+                return
+            self.paced += 1
+            await asyncio.sleep(self.window - (now - sent_at[0]))
+
+    async def _work(self, channel_id):
+        queue = self._queues[channel_id]
+        try:
+            while queue:
+                if queue[0][-1].cancelled():
+                    heapq.heappop(queue)
+                    continue
+                await self._pace(channel_id)
+                # Tras la espera puede haber llegado algo más prioritario
+                _, _, channel, content, kwargs, future = heapq.heappop(queue)
+                if future.cancelled():
+                    continue
+                try:
+                    message = await channel.send(content, **kwargs)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                    continue
+                self.sent += 1
+                DISCORD_SENDS.inc(action="send")
+                if not future.cancelled():
+                    future.set_result(message)
+        finally:
+            del self._workers[channel_id]
+            if not queue:
+                del self._queues[channel_id]
+            # Olvidar la ventana del canal cuando ya no limite nada
+            asyncio.get_running_loop().call_later(self.window, self._forget, channel_id)
+
+    def _forget(self, channel_id):
+        sent_at = self._sent_at.get(channel_id)
+        if channel_id not in self._workers and sent_at is not None:
+            if not sent_at or asyncio.get_running_loop().time() - sent_at[-1] >= self.window:
+                del self._sent_at[channel_id]
@@ -0,0 +1,202 @@
+import asyncio
+import os
+import re
+from datetime import timedelta
+import google.generativeai as genai
+from google.generativeai import caching
+from dotenv import load_dotenv
+from cache import LRUCache
+from context_builder import estimate_tokens
+
+load_dotenv()
+
+# Sesiones de chat por usuario: máximo en memoria y segundos de inactividad antes de expulsarlas
+CHAT_SESSION_MAX_USERS = int(os.getenv("CHAT_SESSION_MAX_USERS", "1000"))
+CHAT_SESSION_IDLE = float(os.getenv("CHAT_SESSION_IDLE", "1800"))
+# Caché de contexto de Gemini para las instrucciones del sistema y su duración (segundos)
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = float(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+# La caché de contexto exige una versión fija del modelo (p. ej. gemini-1.5-flash-002) y un mínimo de tokens
+GEMINI_CONTEXT_CACHE_MODEL = os.getenv("GEMINI_CONTEXT_CACHE_MODEL") or None
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "32768"))
+PINNED_MODEL = re.compile(r"-\d{3}$")
+
+SUMMARY_PREFIX = "Resumen de la conversación anterior: "
+# Las respuestas de error empiezan así: nunca se guardan en caché ni se reenvían como turnos del modelo
+ERROR_REPLY_PREFIXES = ("❌", "⏱️", "⏳")
+
+
+def user_content(*parts):
+    return {"role": "user", "parts": list(parts)}
+
+
+def model_content(text):
+    return {"role": "model", "parts": [text]}
+
+
+def _turn_key(turn):
+    # MongoDB guarda las fechas con precisión de milisegundos: la clave debe sobrevivir al viaje de ida y vuelta
+    timestamp = turn["timestamp"]
+    return timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+
+
+def usable_turn(turn):
+    """Turnos que se pueden enviar al modelo: sin respuestas vacías ni mensajes de error"""
+    response = turn["response"]
+    return bool(response and response.strip()) and not response.startswith(ERROR_REPLY_PREFIXES)
+
+
+class ChatSession:
+    """Historial de un usuario convertido a turnos user/model de Gemini.
+
+    Se conserva entre mensajes: al llegar un turno nuevo solo se convierte
+    ese turno, y los que salen del presupuesto de tokens se quitan del
+    principio sin reconstruir el resto.
+    """
+
+    __slots__ = ("keys", "contents")
+
+    def __init__(self):
+        self.keys = []
+        self.contents = []
+
+    def sync(self, turns):
+        """Alinear la sesión con `turns` (del más antiguo al más reciente)"""
+        keys = [_turn_key(turn) for turn in turns]
+        # Turnos que ya no caben en el prompt
+        start = self.keys.index(keys[0]) if keys and keys[0] in self.keys else len(self.keys)
+        kept = self.keys[start:]
+        if keys[:len(kept)] != kept:
+            # El historial cambió por otra vía (reset, otro worker...): reconstruir
+            start, kept = len(self.keys), []
+        self.keys = kept + keys[len(kept):]
+        self.contents = self.contents[2 * start:]
+        for turn in turns[len(kept):]:
+            self.contents.append(user_content(turn["message"]))
+            self.contents.append(model_content(turn["response"]))
+
+
+class SessionManager:
+    """Sesiones de chat estructuradas por usuario, con expulsión LRU de las inactivas.
+
+    El historial se envía como turnos con rol (user/model) en lugar de un
+    único texto unido con saltos de línea. `context_builder` decide qué
+    turnos caben en el presupuesto de tokens.
+    """
+
+    def __init__(self, context_builder, max_users=CHAT_SESSION_MAX_USERS, idle_ttl=CHAT_SESSION_IDLE):
+        self.context_builder = context_builder
+        self._sessions = LRUCache(max_users, ttl=idle_ttl)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def hits(self):
+        return self._sessions.hits
+
+    @property
+    def misses(self):
+        return self._sessions.misses
+
+    def build(self, user_id, turns, text, summary=None):
+        """Devolver (contents para Gemini, turnos descartados) para el mensaje `text`"""
+        kept, evicted = self.context_builder.select(turns, text, summary)
+        kept = [turn for turn in kept if usable_turn(turn)]
+        session = self._sessions.get(str(user_id)) or ChatSession()
+        session.sync(kept)
+        # Volver a guardarla renueva su plazo de inactividad
+        self._sessions.set(str(user_id), session)
+        contents = session.contents + [user_content(text)]
+        if summary:
+            # Gemini espera turnos alternos: el resumen va dentro del primer turno del usuario
+            contents[0] = user_content(SUMMARY_PREFIX + summary, *contents[0]["parts"])
+        return contents, evicted
+
+    def invalidate(self, user_id):
+        self._sessions.pop(str(user_id))
+
+
+class SystemPromptCache:
+    """Instrucciones del sistema en la caché de contexto de Gemini.
+
+    Con GEMINI_CONTEXT_CACHE=true se guarda el prompt del sistema compartido
+    como CachedContent y las peticiones usan modelos derivados de él, así no
+    se reenvía en cada turno. Si el modelo no admite caché de contexto (hace
+    falta una versión fija, GEMINI_CONTEXT_CACHE_MODEL, y un mínimo de tokens)
+    o la caché deja de estar disponible, se usan los modelos normales. Esas
+    dos condiciones se comprueban antes de llamar a la API.
+    """
+
+    def __init__(self, enabled=GEMINI_CONTEXT_CACHE, ttl=GEMINI_CONTEXT_CACHE_TTL,
+                 model_name=GEMINI_CONTEXT_CACHE_MODEL, min_tokens=GEMINI_CONTEXT_CACHE_MIN_TOKENS):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.model_name = model_name
+        self.min_tokens = min_tokens
+        self.cached = None
+        self._models = {}
+        self._task = None
+
+    @property
+    def active(self):
+        return bool(self._models)
+
+    def model(self, kind, default):
+        """Modelo con las instrucciones en caché para `kind` ("text", "image"), o `default`"""
+        return self._models.get(kind, default)
+
+    async def start(self, model_name, system_instruction, generation_configs, safety_settings):
+        """Crear la caché; `generation_configs` es {tipo: generation_config}"""
+        if not self.enabled:
+            return
+        model_name = self.model_name or model_name
+        if not PINNED_MODEL.search(model_name):
+            print(f"ℹ️ Caché de contexto desactivada: {model_name} no es una versión fija (GEMINI_CONTEXT_CACHE_MODEL)")
+            return
+        tokens = estimate_tokens(system_instruction)
+        if tokens < self.min_tokens:
+            print(f"ℹ️ Caché de contexto desactivada: las instrucciones ocupan ~{tokens} tokens "
+                  f"y el mínimo es {self.min_tokens}")
+            return
+        try:
+            self.cached = await asyncio.to_thread(
+                caching.CachedContent.create,
+                model=model_name,
+                display_name="lyla-system-instruction",
+                system_instruction=system_instruction,
+                ttl=timedelta(seconds=self.ttl)
+            )
+        except Exception as e:
+            print(f"⚠️ Caché de contexto no disponible, se envían las instrucciones en cada petición: {e}")
+            return
+        self._models = {
+            kind: genai.GenerativeModel.from_cached_content(
+                self.cached, generation_config=config, safety_settings=safety_settings
+            )
+            for kind, config in generation_configs.items()
+        }
+        self._task = asyncio.create_task(self._keep_alive())
+        print(f"✅ Instrucciones del sistema en caché de contexto ({self.cached.name})")
+
+    async def _keep_alive(self):
+        # Renovar la caché antes de que caduque mientras el bot siga en marcha
+        while True:
+            await asyncio.sleep(self.ttl / 2)
+            try:
+                await asyncio.to_thread(self.cached.update, ttl=timedelta(seconds=self.ttl))
+            except Exception as e:
+                print(f"⚠️ No se pudo renovar la caché de contexto, se usan los modelos normales: {e}")
+                self._models = {}
+                return
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        self._models = {}
+        if self.cached is not None:
+            try:
+                await asyncio.to_thread(self.cached.delete)
+            except Exception as e:
+                print(f"Error borrando la caché de contexto: {e}")
+            self.cached = None
@@ -0,0 +1,116 @@
+import asyncio
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Ventana (segundos) para agrupar mensajes seguidos y máximo de mensajes pendientes por canal
+TURN_COALESCE_WINDOW = float(os.getenv("TURN_COALESCE_WINDOW", "0.75"))
+TURN_MAX_PENDING = int(os.getenv("TURN_MAX_PENDING", "5"))
+# Espera antes de atender el primer mensaje con la cola vacía (0 = enseguida, sin agrupar su ráfaga)
+TURN_FIRST_WAIT = float(os.getenv("TURN_FIRST_WAIT", str(TURN_COALESCE_WINDOW)))
+
+
+class TurnQueue:
+    """Colas de turnos por clave (el usuario, dueño del historial).
+
+    Los turnos de una misma clave se atienden de uno en uno y en orden, así
+    que cada generación ve el historial guardado por la anterior, aunque el
+    usuario escriba a la vez en varios canales. Los mensajes se agrupan por
+    `group` (el canal) y, cuando la ráfaga se calma, se entregan juntos al
+    handler como un solo turno. El primer mensaje con la cola vacía espera
+    `first_wait` por si llega el resto de la ráfaga: con 0 se atiende enseguida,
+    a costa de una generación extra (y con la pregunta incompleta) cuando el
+    usuario escribe en varios mensajes.
+
+    Si un grupo acumula más de `max_pending` mensajes, `merge(anterior, nuevo)`
+    une los dos más antiguos en uno, ya que acabarían en el mismo turno; sin
+    `merge` se descarta el más antiguo de ese grupo. Nunca se toca otro grupo.
+    """
+
+    def __init__(self, handler, coalesce_window=TURN_COALESCE_WINDOW, max_pending=TURN_MAX_PENDING,
+                 first_wait=TURN_FIRST_WAIT, merge=None):
+        self._handler = handler
+        self.coalesce_window = coalesce_window
+        self.max_pending = max_pending
+        self.first_wait = first_wait
+        self._merge = merge
+        self._pending = {}
+        self._workers = {}
+        self.submitted = 0
+        self.batches = 0
+        self.merged = 0
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        """Mensajes en espera en todas las colas"""
+        return sum(len(items) for items in self._pending.values())
+
+    def submit(self, key, item, group=None):
+        """Encolar un mensaje y arrancar el worker de la clave si no existe"""
+        pending = self._pending.setdefault(key, [])
+        pending.append((group, item))
+        self.submitted += 1
+        same_group = [index for index, entry in enumerate(pending) if entry[0] == group]
+        if len(same_group) > self.max_pending:
+            first, second = same_group[:2]
+            if self._merge is not None:
+                pending[first] = (group, self._merge(pending[first][1], pending[second][1]))
+                self.merged += 1
+            else:
+                pending[first] = pending[second]
+                self.dropped += 1
+            del pending[second]
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key))
+
+    def discard(self, key):
+        """Descartar los mensajes pendientes de una clave (el turno en curso sigue)"""
+        self.dropped += len(self._pending.pop(key, ()))
+
+    async def drain(self):
+        """Esperar a que se atiendan todos los turnos encolados"""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def _settle(self, key, wait):
+        # Esperar `wait` y seguir mientras la ráfaga crezca, como mucho tres ventanas más
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait + self.coalesce_window * 3
+        seen = len(self._pending.get(key, ()))
+        await asyncio.sleep(wait)
+        while len(self._pending.get(key, ())) != seen and loop.time() < deadline:
+            seen = len(self._pending.get(key, ()))
+            await asyncio.sleep(self.coalesce_window)
+
+    def _take_batch(self, key):
+        # Los mensajes del mismo grupo que el más antiguo; el resto sigue en cola, en orden
+        pending = self._pending.pop(key, None)
+        if not pending:
+            return None
+        group = pending[0][0]
+        rest = [entry for entry in pending if entry[0] != group]
+        if rest:
+            self._pending[key] = rest
+        return [item for entry_group, item in pending if entry_group == group]
+
+    async def _work(self, key):
+        try:
+            if self.first_wait > 0:
+                await self._settle(key, self.first_wait)
+            elif len(self._pending.get(key, ())) > 1:
+                await self._settle(key, self.coalesce_window)
+            while True:
+                batch = self._take_batch(key)
+                if not batch:
+                    return
+                self.batches += 1
+                try:
+                    await self._handler(batch)
+                except Exception as e:
+                    print(f"Error procesando turno de {key}: {e}")
+                if key in self._pending:
+                    await self._settle(key, self.coalesce_window)
+        finally:
+            self._workers.pop(key, None)
@@ -1,175 +1,301 @@
-
-from flask import Flask, jsonify, render_template_string
-import threading
+import asyncio
+import html
+import json
 import os
 import logging
 import time
-from main import bot, DISCORD_BOT_TOKEN, db
+from datetime import datetime
+from string import Template
+from aiohttp import web
+from metrics import registry, merge_families, render
+from database import AsyncBotDatabase, CONVERSATIONS_PAGE_MAX, decode_cursor
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+# Rutas que se agregan al servidor aiohttp
+routes = web.RouteTableDef()
+
+# Dependencias inyectadas por quien arranca el servidor (main.py o cluster.py)
+db = None
+# Función que devuelve el estado de este proceso del bot (main.worker_status)
+local_status = None
+# Estados publicados por los workers cuando el bot se ejecuta con cluster.py
+cluster_status = None
+# Mismo intervalo que usan los workers para publicar su estado
+CLUSTER_STATUS_INTERVAL = float(os.getenv("CLUSTER_STATUS_INTERVAL", "15"))
+# Conversaciones leídas por consulta al exportar en NDJSON
+EXPORT_PAGE_SIZE = 500
 
-@app.route('/')
-def home():
+DASHBOARD_HTML = Template("""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Lyla Bot Dashboard</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 20px; background: #2c2f33; color: white; }
+        .container { max-width: 1200px; margin: 0 auto; }
+        .stats-grid { display: grid; grid-template-columns: repeat(auto-fit, minmax(250px, 1fr)); gap: 20px; }
+        .stat-card { background: #36393f; padding: 20px; border-radius: 10px; border-left: 4px solid #7289da; }
+        .stat-number { font-size: 2em; font-weight: bold; color: #7289da; }
+        h1 { color: #7289da; text-align: center; }
+        h2 { color: #99aab5; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>🤖 Lyla Bot Dashboard</h1>
+        <div class="stats-grid">
+            <div class="stat-card">
+                <h2>💬 Total Conversaciones</h2>
+                <div class="stat-number">$total_conversations</div>
+            </div>
+            <div class="stat-card">
+                <h2>👥 Usuarios Únicos</h2>
+                <div class="stat-number">$total_users</div>
+            </div>
+            <div class="stat-card">
+                <h2>🏠 Servidores</h2>
+                <div class="stat-number">$total_servers</div>
+            </div>
+            <div class="stat-card">
+                <h2>🟢 Estado del Bot</h2>
+                <div class="stat-number">$bot_status</div>
+            </div>
+        </div>
+    </div>
+</body>
+</html>
+""")
+
+async def collect_status():
+    """Estado del bot: el de este proceso o el agregado de todos los workers del cluster"""
+    if cluster_status is None:
+        statuses = [local_status()] if local_status else []
+    else:
+        # El dict del Manager es un proxy IPC: leerlo fuera del event loop
+        statuses = await asyncio.to_thread(lambda: [dict(status) for status in cluster_status.values()])
+        # Un worker que deja de publicar se considera caído
+        stale_before = time.time() - CLUSTER_STATUS_INTERVAL * 3
+        for status in statuses:
+            status["ready"] = status["ready"] and status["updated"] >= stale_before
+    ready = [status for status in statuses if status["ready"]]
+    latencies = [status["latency"] for status in ready if status["latency"] is not None]
+    return {
+        "ready": bool(statuses) and len(ready) == len(statuses),
+        "any_ready": bool(ready),
+        "bot_name": ready[0]["bot_name"] if ready else "Lyla",
+        "bot_id": ready[0]["bot_id"] if ready else None,
+        "guild_count": sum(status["guild_count"] for status in ready),
+        "user_count": sum(status["user_count"] for status in ready),
+        "latency": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "workers": len(statuses),
+        "workers_ready": len(ready),
+        "shard_ids": sorted(shard_id for status in statuses for shard_id in status["shard_ids"])
+    }
+
+def cluster_fields(status):
+    """Campos extra que solo se incluyen cuando hay varios workers"""
+    if cluster_status is None:
+        return {}
+    return {"workers": status["workers"], "workers_ready": status["workers_ready"], "shard_ids": status["shard_ids"]}
+
+@routes.get('/')
+async def home(request):
     try:
-        bot_status = "ready" if bot.is_ready() else "connecting"
-        return jsonify({
+        status = await collect_status()
+        bot_status = "ready" if status["ready"] else "connecting"
+        return web.json_response({
             "status": "Bot is running",
             "bot_status": bot_status,
-            "bot_name": bot.user.name if bot.user else "Lyla",
-            "guild_count": len(bot.guilds) if bot.is_ready() else 0,
+            "bot_name": status["bot_name"],
+            "guild_count": status["guild_count"],
             "version": "1.0.0",
-            "message": "Lyla Discord Bot está funcionando correctamente"
+            "message": "Lyla Discord Bot está funcionando correctamente",
+            **cluster_fields(status)
         })
     except Exception as e:
         logger.error(f"Error in home route: {e}")
-        return jsonify({
+        return web.json_response({
             "status": "Bot is running", 
             "message": "Lyla Discord Bot está funcionando",
             "version": "1.0.0"
         })
 
-@app.route('/health')
-def health():
+@routes.get('/health')
+async def health(request):
     try:
-        return jsonify({
+        status = await collect_status()
+        return web.json_response({
             "status": "healthy",
-            "bot_ready": bot.is_ready(),
+            "bot_ready": status["ready"],
             "uptime": "online",
-            "timestamp": int(time.time())
+            "timestamp": int(time.time()),
+            **cluster_fields(status)
         })
     except Exception as e:
         logger.error(f"Error in health route: {e}")
-        return jsonify({"status": "healthy", "message": "Service is running"}), 200
+        return web.json_response({"status": "healthy", "message": "Service is running"}, status=200)
 
-@app.route('/stats')
-def stats():
+@routes.get('/stats')
+async def stats(request):
     try:
-        if not bot.is_ready():
-            return jsonify({
+        status = await collect_status()
+        if not status["any_ready"]:
+            return web.json_response({
                 "message": "Bot is connecting...",
                 "guild_count": 0,
                 "user_count": 0,
-                "bot_name": "Lyla"
+                "bot_name": "Lyla",
+                **cluster_fields(status)
             })
         
-        return jsonify({
-            "guild_count": len(bot.guilds),
-            "user_count": sum(guild.member_count for guild in bot.guilds if guild.member_count),
-            "bot_name": bot.user.name,
-            "bot_id": bot.user.id,
-            "latency": round(bot.latency * 1000, 2)
+        return web.json_response({
+            "guild_count": status["guild_count"],
+            "user_count": status["user_count"],
+            "bot_name": status["bot_name"],
+            "bot_id": status["bot_id"],
+            "latency": status["latency"],
+            **cluster_fields(status)
         })
     except Exception as e:
         logger.error(f"Error in stats route: {e}")
-        return jsonify({"error": "Failed to get stats"}), 500
+        return web.json_response({"error": "Failed to get stats"}, status=500)
 
-@app.route('/dashboard')
-def dashboard():
+@routes.get('/dashboard')
+async def dashboard(request):
     """Dashboard web con estadísticas"""
     if not db:
-        return jsonify({"error": "Database not available"}), 503
+        return web.json_response({"error": "Database not available"}, status=503)
     
     try:
-        global_stats = db.get_global_stats()
-        
-        dashboard_html = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Lyla Bot Dashboard</title>
-            <style>
-                body { font-family: Arial, sans-serif; margin: 20px; background: #2c2f33; color: white; }
-                .container { max-width: 1200px; margin: 0 auto; }
-                .stats-grid { display: grid; grid-template-columns: repeat(auto-fit, minmax(250px, 1fr)); gap: 20px; }
-                .stat-card { background: #36393f; padding: 20px; border-radius: 10px; border-left: 4px solid #7289da; }
-                .stat-number { font-size: 2em; font-weight: bold; color: #7289da; }
-                h1 { color: #7289da; text-align: center; }
-                h2 { color: #99aab5; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>🤖 Lyla Bot Dashboard</h1>
-                <div class="stats-grid">
-                    <div class="stat-card">
-                        <h2>💬 Total Conversaciones</h2>
-                        <div class="stat-number">{{ total_conversations }}</div>
-                    </div>
-                    <div class="stat-card">
-                        <h2>👥 Usuarios Únicos</h2>
-                        <div class="stat-number">{{ total_users }}</div>
-                    </div>
-                    <div class="stat-card">
-                        <h2>🏠 Servidores</h2>
-                        <div class="stat-number">{{ total_servers }}</div>
-                    </div>
-                    <div class="stat-card">
-                        <h2>🟢 Estado del Bot</h2>
-                        <div class="stat-number">{{ bot_status }}</div>
-                    </div>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+        global_stats, status = await asyncio.gather(db.get_global_stats(), collect_status())
         
-        return render_template_string(dashboard_html, 
-                                    total_conversations=global_stats['total_conversations'],
-                                    total_users=global_stats['total_users'],
-                                    total_servers=global_stats['total_servers'],
-                                    bot_status="🟢 Online" if bot.is_ready() else "🟡 Connecting")
+        return web.Response(
+            text=DASHBOARD_HTML.substitute(
+                total_conversations=global_stats['total_conversations'],
+                total_users=global_stats['total_users'],
+                total_servers=global_stats['total_servers'],
+                bot_status=html.escape("🟢 Online" if status["ready"] else "🟡 Connecting")
+            ),
+            content_type="text/html"
+        )
     except Exception as e:
         logger.error(f"Error in dashboard: {e}")
-        return jsonify({"error": "Failed to load dashboard"}), 500
+        return web.json_response({"error": "Failed to load dashboard"}, status=500)
 
-@app.route('/api/conversations/<user_id>')
-def get_user_conversations(user_id):
-    """API para obtener conversaciones de un usuario"""
+@routes.get('/api/conversations/{user_id}')
+async def get_user_conversations(request):
+    """API para obtener conversaciones de un usuario.
+
+    Parámetros: `limit` (tamaño de página), `cursor` (valor de `next_cursor` de la
+    página anterior), `since` (fecha ISO 8601) y `format=ndjson` para exportar
+    todo el historial en streaming, una conversación por línea.
+    """
     if not db:
-        return jsonify({"error": "Database not available"}), 503
+        return web.json_response({"error": "Database not available"}, status=503)
     
+    user_id = request.match_info["user_id"]
     try:
-        conversations = db.get_user_history(user_id, 50)  # Últimas 50
-        return jsonify({
+        limit = min(max(int(request.query.get("limit", 50)), 1), CONVERSATIONS_PAGE_MAX)
+        since = datetime.fromisoformat(request.query["since"]) if "since" in request.query else None
+        if since and since.tzinfo:
+            # Las fechas se guardan sin zona, en hora local del bot (datetime.now())
+            since = since.astimezone().replace(tzinfo=None)
+        cursor = request.query.get("cursor")
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError as e:
+        return web.json_response({"error": f"Invalid parameter: {e}"}, status=400)
+    
+    if request.query.get("format") == "ndjson":
+        return await export_conversations(request, user_id, since)
+    
+    try:
+        conversations, next_cursor = await db.get_conversations_page(user_id, limit, cursor, since, truncate=100)
+        return web.json_response({
             "user_id": user_id,
             "conversation_count": len(conversations),
             "conversations": [
                 {
                     "message": conv["message"],
-                    "response": conv["response"][:100] + "..." if len(conv["response"]) > 100 else conv["response"],
+                    "response": conv["response"],
                     "timestamp": conv["timestamp"].isoformat()
                 } for conv in conversations
-            ]
+            ],
+            "next_cursor": next_cursor
         })
     except Exception as e:
         logger.error(f"Error getting user conversations: {e}")
-        return jsonify({"error": "Failed to get conversations"}), 500
+        return web.json_response({"error": "Failed to get conversations"}, status=500)
 
-def run_bot():
-    """Run the Discord bot in a separate thread"""
+async def export_conversations(request, user_id, since):
+    """Historial completo en NDJSON, leído página a página (memoria acotada a una página)"""
+    response = web.StreamResponse(headers={
+        "Content-Type": "application/x-ndjson; charset=utf-8",
+        "Content-Disposition": f'attachment; filename="conversations-{user_id}.ndjson"'
+    })
+    await response.prepare(request)
+    cursor = None
     try:
-        logger.info("Starting Discord bot...")
-        bot.run(DISCORD_BOT_TOKEN)
+        while True:
+            conversations, cursor = await db.get_conversations_page(user_id, EXPORT_PAGE_SIZE, cursor, since)
+            lines = "".join(json.dumps({
+                "message": conv["message"],
+                "response": conv["response"],
+                "timestamp": conv["timestamp"].isoformat()
+            }, ensure_ascii=False) + "\n" for conv in conversations)
+            await response.write(lines.encode("utf-8"))
+            if cursor is None:
+                break
     except Exception as e:
-        logger.error(f"Error starting bot: {e}")
+        # Las cabeceras ya se enviaron: cortar el stream para que el cliente vea la exportación incompleta
+        logger.error(f"Error exporting user conversations: {e}")
+        raise
+    await response.write_eof()
+    return response
 
-def run_web_server():
-    """Run the Flask web server"""
-    port = int(os.environ.get('PORT', 5000))
-    logger.info(f"Starting web server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+@routes.get('/metrics')
+async def metrics(request):
+    """Métricas en formato de texto de Prometheus"""
+    families = registry.collect()
+    if cluster_status is not None:
+        # Cada worker publica sus métricas junto con su estado
+        statuses = await asyncio.to_thread(lambda: dict(cluster_status))
+        for worker_id, status in sorted(statuses.items()):
+            merge_families(families, status.get("metrics", ()), worker=worker_id)
+    return web.Response(
+        body=render(families).encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
 
-if __name__ == '__main__':
-    # Start bot in a separate thread
-    bot_thread = threading.Thread(target=run_bot, daemon=True)
-    bot_thread.start()
+async def start_web_server(status=None, database=None, statuses=None):
+    """Arrancar el servidor web en el event loop actual; devuelve el runner para cerrarlo"""
+    global local_status, db, cluster_status
+    local_status, db, cluster_status = status, database, statuses
     
-    # Give the bot a moment to start
-    time.sleep(2)
+    app = web.Application()
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = int(os.environ.get('PORT', 5000))
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logger.info(f"Web server listening on port {port}")
+    return runner
+
+async def serve_cluster(statuses):
+    """Servir la web en el proceso lanzador del cluster (sin bot propio)"""
+    try:
+        database = AsyncBotDatabase()
+    except Exception as e:
+        logger.error(f"Database not available: {e}")
+        database = None
     
-    # Start web server in main thread
-    run_web_server()
+    runner = await start_web_server(database=database, statuses=statuses)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        if database:
+            await database.close()